@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# asyncio front end, for Python 3 event loops. It talks to pmcd, which
+# keeps the board open and does all of the USB I/O on its own scan thread,
+# so nothing here blocks the loop on libftdi:
+#
+#   async with aiopmc.client() as dev:
+#       record = await dev.read(['CH0', 'CH16'])
+#       await dev.toggle(['POWER'])
+#       async for t, record in dev.stream(['CH0'], rate=100):
+#           ...
+
+import argparse
+import asyncio
+import collections
+import json
+
+SOCKET = '/tmp/pmcd.sock'
+
+# As pmc.sample.
+sample = collections.namedtuple('sample', ['shunt', 'bus', 'current', 'power', 'failed'])
+
+def decode(ret):
+    return ret['t'], collections.OrderedDict((v[0], sample(*v[1:])) for v in ret['values'])
+
+async def receive(reader):
+    line = await reader.readline()
+    if not line:
+        raise Exception("Daemon closed the connection")
+    ret = json.loads(line)
+    if 'error' in ret:
+        raise Exception(ret['error'])
+    return ret
+
+class client(object):
+    # Requests share one connection, each stream gets its own. Concurrent
+    # read() calls are coalesced into a single request of every scanned
+    # channel. dropped counts the records skipped by the daemon because a
+    # stream's consumer fell behind.
+    def __init__(self, path=SOCKET, board=None):
+        self.path = path
+        self.board = board
+        self.sensors = None
+        self.pending = None
+        self.dropped = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def connect(self):
+        return await asyncio.open_unix_connection(self.path)
+
+    def send(self, writer, **req):
+        if self.board is not None:
+            req['board'] = self.board
+        writer.write((json.dumps(req, separators=(',', ':')) + '\n').encode())
+
+    async def open(self):
+        self.lock = asyncio.Lock()
+        self.reader, self.writer = await self.connect()
+        self.sensors = (await self.request(op='info'))['sensors']
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def request(self, **req):
+        async with self.lock:
+            self.send(self.writer, **req)
+            await self.writer.drain()
+            return await receive(self.reader)
+
+    def read_done(self, future):
+        self.pending = None
+
+    async def read(self, channels):
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self.request(op='read'))
+            self.pending.add_done_callback(self.read_done)
+        # One caller giving up must not cancel the others' read.
+        t, record = decode(await asyncio.shield(self.pending))
+        return collections.OrderedDict((chan, record[chan]) for chan in channels
+                                       if chan in record)
+
+    async def stream(self, channels, rate=None, count=None):
+        # Yields (t, record). A line is only read when the consumer asks for
+        # the next record, so a slow consumer fills the socket and the
+        # daemon backs off instead of records queueing up here.
+        channels = [chan for chan in channels if chan in self.sensors]
+        reader, writer = await self.connect()
+        try:
+            self.send(writer, op='stream', channels=channels, count=count, rate=rate)
+            await writer.drain()
+            n = 0
+            while count is None or n < count:
+                ret = await receive(reader)
+                self.dropped += ret.get('dropped', 0)
+                yield decode(ret)
+                n += 1
+        finally:
+            writer.close()
+
+    async def on(self, sw_list):
+        await self.request(op='on', switches=sw_list)
+
+    async def off(self, sw_list):
+        await self.request(op='off', switches=sw_list)
+
+    async def toggle(self, sw_list):
+        await self.request(op='toggle', switches=sw_list)
+
+    async def switch_states(self, sw_list):
+        # (name, on, pin level) of each of sw_list.
+        ret = await self.request(op='read_sw', switches=sw_list)
+        return [tuple(s) for s in ret['switches']]
+
+async def main(args):
+    async with client(args.socket, args.board) as dev:
+        channels = args.channels or list(dev.sensors)
+        async for t, record in dev.stream(channels, args.rate, args.count):
+            print('{:.6f} '.format(t) + ' '.join('{:g}'.format(s.power if s.current is not None
+                                                              else s.bus)
+                                                 for s in record.values()))
+        if dev.dropped:
+            print('# {} records dropped'.format(dev.dropped))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', '--socket', type=str, default=SOCKET)
+    parser.add_argument('-b', '--board', type=str, required=False)
+    parser.add_argument('-r', '--rate', type=float, required=False)
+    parser.add_argument('-c', '--count', type=int, default=10)
+    parser.add_argument('channels', nargs='*')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Acquisition benchmark. Drives pmc.read_scans() through a set of
+# scenarios against a board (-s/-i) or the simulator (default) and prints
+# one JSON document. On the simulator rates and latencies are in
+# simulated time, host CPU time is always real.
+
+import argparse
+import ftdi_sim
+import json
+import pmc
+import sys
+import time
+
+class counting_port(object):
+    # Wraps a port, counting USB transfers and their sizes. A round trip
+    # is a read following a write.
+    def __init__(self, port):
+        self.port = port
+        self.reset()
+
+    def reset(self):
+        self.writes = 0
+        self.reads = 0
+        self.written = 0
+        self.read_bytes = 0
+        self.round_trips = 0
+        self.last_write = False
+
+    def set_bitmode(self, mask, mode):
+        return self.port.set_bitmode(mask, mode)
+
+    def write(self, buf):
+        ret = self.port.write(buf)
+        self.writes += 1
+        self.written += len(buf)
+        self.last_write = True
+        return ret
+
+    def read(self, buf, size):
+        ret = self.port.read(buf, size)
+        if ret > 0:
+            self.reads += 1
+            self.read_bytes += ret
+            if self.last_write:
+                self.round_trips += 1
+            self.last_write = False
+        return ret
+
+def percentiles(values):
+    values = sorted(values)
+    def at(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return dict(min=values[0], p50=at(0.50), p90=at(0.90), p99=at(0.99), max=values[-1])
+
+def measure(device, port, clock, name, channels, scans, batch):
+    device.read_scans(channels, 1)
+    port.reset()
+    counters = device.i2c.instrument()
+    latencies = []
+    cpu = time.clock()
+    start = clock()
+    done = 0
+    while done < scans:
+        n = min(batch, scans - done)
+        t = clock()
+        device.read_scans(channels, n)
+        latencies.append(clock() - t)
+        done += n
+    elapsed = clock() - start
+    cpu = time.clock() - cpu
+    profile = counters.snapshot()
+    device.i2c.instrument(False)
+    return dict(
+        name=name,
+        channels=channels,
+        scans=scans,
+        batch=batch,
+        scans_per_sec=scans / elapsed if elapsed else None,
+        bytes_written_per_scan=float(port.written) / scans,
+        bytes_read_per_scan=float(port.read_bytes) / scans,
+        usb_writes=port.writes,
+        usb_reads=port.reads,
+        usb_round_trips_per_scan=float(port.round_trips) / scans,
+        cpu_per_scan=cpu / scans,
+        latency=percentiles(latencies),
+        profile=profile)
+
+def channel_latency(device, clock, channels, reads):
+    ret = dict()
+    for chan in channels:
+        device.read([chan])
+        latencies = []
+        for i in range(0, reads):
+            t = clock()
+            device.read([chan])
+            latencies.append(clock() - t)
+        ret[chan] = percentiles(latencies)
+    return ret
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--mapping', type=argparse.FileType('rb'), required=False)
+    parser.add_argument('-s', '--serial', type=str, required=False)
+    parser.add_argument('-i', '--index', type=int, required=False)
+    parser.add_argument('-n', '--scans', type=int, default=50)
+    parser.add_argument('-b', '--batch', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=125e-6)
+    parser.add_argument('--per-channel', type=int, default=0)
+    args = parser.parse_args()
+
+    hardware = args.serial is not None or args.index is not None
+    points, mappings = pmc.load_mappings(args.mapping)
+    board = None
+    if hardware:
+        device = pmc.pmc(args.serial, args.index)
+        clock = time.time
+    else:
+        board = ftdi_sim.pmc17(pmc.addrs, pmc.alert)
+        device = pmc.pmc(port=ftdi_sim.port(board, pmc.scl, pmc.sda_out, pmc.sda_in, latency=args.latency))
+        clock = device.hw.port.elapsed
+    pmc.add_mappings(device, points, mappings, board)
+    port = device.hw.port = counting_port(device.hw.port)
+
+    everything = ["CH" + str(i) for i in range(0, 17)]
+    for chan in everything:
+        if chan not in device.sensors:
+            device.add_sensor(chan, 0x4e if chan == "CH16" else 0x4f,
+                              None, None if chan == "CH16" else int(chan[2:]))
+    scenarios = [("all", everything), ("single", ["CH0"])]
+    if args.mapping is not None:
+        scenarios.append(("mapping", [name for name in mappings if name in device.sensors]))
+
+    results = []
+    for name, channels in scenarios:
+        result = measure(device, port, clock, name, channels, args.scans, args.batch)
+        if args.per_channel:
+            result['channel_latency'] = channel_latency(device, clock, channels, args.per_channel)
+        results.append(result)
+
+    json.dump(dict(transport="ftdi" if hardware else "sim", results=results),
+              sys.stdout, indent=2, sort_keys=True)
+    print
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Micro-benchmark of the host side cost of a scan: queueing the MPSSE
+# commands and handing responses back to their consumers. The device is
+# replaced by a loopback that accepts everything and answers with zeros,
+# so only CPU time in i2c/i2c_ftdi is measured.
+
+import argparse
+import i2c
+import i2c_ftdi
+import pmc
+import time
+
+class loopback_port(object):
+    def __init__(self):
+        self.written = 0
+
+    def set_bitmode(self, mask, mode):
+        return 0
+
+    def write(self, buf):
+        self.written += len(buf)
+        return len(buf)
+
+    def read(self, buf, size):
+        return size
+
+class legacy_ftdi(i2c_ftdi.i2c_ftdi):
+    # The original byte at a time flush path, for comparison.
+    def flush_input(self, count=None):
+        if not isinstance(self.dest, list):
+            self.dest = list(self.dest)
+        while len(self.dest) and not self.hw_error:
+
+            data = bytearray(len(self.dest))
+            ret = self.port.read(data, len(self.dest))
+            if ret < 0:
+                self.hw_error = ret
+                self.i2c_error = True
+                break
+
+            for b in data[:ret]:
+                self.dest.pop(0)[1](b)
+        self.rd_len = len(self.dest)
+
+    def flush_output(self):
+        if self.hw_error or not len(self.wr_buffer):
+            return
+        buf = None
+        for i in self.wr_buffer:
+            if buf is None:
+                buf = chr(i)
+            else:
+                buf += chr(i)
+        ret = self.port.write(buf)
+        if ret < 0:
+            self.hw_error = ret
+            self.i2c_error = True
+        self.wr_buffer = bytearray()
+        self.marks = []
+
+    def flush_all(self):
+        self.flush_output()
+        self.flush_input()
+
+    def cmd(self, cmd, *args):
+        self.wr_buffer.extend([cmd] + list(args))
+
+def make_device(engine):
+    port = loopback_port()
+    device = pmc.pmc(port=port)
+    device.hw = engine(port, pmc.scl, pmc.sda_out, pmc.sda_in, 400000, pmc.initial_output)
+    device.i2c = i2c.i2c(device.hw)
+    for i in range(0, 16):
+        device.add_sensor("CH" + str(i), 0x4f, 0.240, i)
+    device.add_sensor("CH16", 0x4e, 0.050)
+    return device, port
+
+def legacy_read(device, channels):
+    # pmc.read before scans were compiled, rebuilding every transaction.
+    for chan in channels:
+        device.sensors[chan].queue_read(device)
+    device.i2c.flush()
+    for chan in channels:
+        device.sensors[chan].fin()
+
+def current_read(device, channels):
+    device.read(channels)
+
+def run(engine, read, channels, scans):
+    device, port = make_device(engine)
+    read(device, channels)
+    written = port.written
+    start = time.clock()
+    for i in range(0, scans):
+        read(device, channels)
+    cpu = time.clock() - start
+    return cpu / scans, (port.written - written) / scans
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--scans', type=int, default=200)
+    args = parser.parse_args()
+
+    channels = ["CH" + str(i) for i in range(0, 17)]
+    results = []
+    for name, engine, read in (("before", legacy_ftdi, legacy_read),
+                               ("after", i2c_ftdi.i2c_ftdi, current_read)):
+        cpu, written = run(engine, read, channels, args.scans)
+        results.append(cpu)
+        print "{:<6} {:8.1f} us/scan CPU, {} MPSSE bytes/scan".format(name, cpu * 1e6, written)
+    print "speedup {:.2f}x".format(results[0] / results[1])
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Binary capture files. A fixed header is followed by JSON metadata
+# (channel map, shunt values, timebase) and a preallocated ring of fixed
+# width records, each a float64 timestamp, the raw shunt and bus
+# register words of every channel and a flag per channel set where the
+# read was NACKed. The writer appends through a memory map, the reader
+# maps the same file and hands out NumPy views.
+
+import argparse
+import ina226
+import json
+import struct
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = 'PMC17CAP'
+VERSION = 2
+
+# magic, version, header size, capacity in records, records written
+HEADER = struct.Struct('<8sIIQQ')
+COUNT_OFFSET = 24
+ALIGN = 4096
+
+def record_dtype(n):
+    return numpy.dtype([('t', '<f8'), ('shunt', '<i2', (n,)), ('bus', '<u2', (n,)),
+                        ('failed', '?', (n,))])
+
+class writer(object):
+    # Create path holding up to capacity scans of channels, r holds each
+    # channel's shunt value or None. Once full the oldest scans are
+    # overwritten.
+    def __init__(self, path, channels, r, capacity):
+        if numpy is None:
+            raise Exception("numpy is required for capture files")
+        meta = json.dumps(dict(channels=list(channels), r=list(r),
+                               shunt_lsb=ina226.SHUNT_LSB, bus_lsb=ina226.BUS_LSB,
+                               timebase="unix seconds, middle of each scan"))
+        header_size = (HEADER.size + len(meta) + ALIGN - 1) // ALIGN * ALIGN
+        f = open(path, 'wb')
+        f.write(HEADER.pack(MAGIC, VERSION, header_size, capacity, 0))
+        f.write(meta)
+        f.truncate(header_size + capacity * record_dtype(len(channels)).itemsize)
+        f.close()
+
+        self.capacity = capacity
+        self.count = 0
+        self.header = numpy.memmap(path, numpy.uint64, 'r+', COUNT_OFFSET, 1)
+        self.records = numpy.memmap(path, record_dtype(len(channels)), 'r+',
+                                    header_size, capacity)
+
+    def append(self, t, shunt, bus, failed=None):
+        # Add the scans of (samples x channels) raw arrays as returned by
+        # ina226.raw(), t holding the time of each. failed is as returned
+        # by ina226.failed(), None if every read was ACKed.
+        n = len(t)
+        done = max(0, n - self.capacity)
+        self.count += done
+        while done < n:
+            i = self.count % self.capacity
+            take = min(n - done, self.capacity - i)
+            rec = self.records[i:i + take]
+            rec['t'] = t[done:done + take]
+            rec['shunt'] = shunt[done:done + take]
+            rec['bus'] = bus[done:done + take]
+            rec['failed'] = False if failed is None else failed[done:done + take]
+            self.count += take
+            done += take
+        # Publish the count after the records, a reader of the live file
+        # never sees a record before it is written.
+        self.header[0] = self.count
+
+    def close(self):
+        self.records.flush()
+        self.header.flush()
+        del self.records
+        del self.header
+
+class reader(object):
+    def __init__(self, path):
+        if numpy is None:
+            raise Exception("numpy is required for capture files")
+        f = open(path, 'rb')
+        magic, version, header_size, capacity, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise Exception("Not a capture file", path)
+        self.meta = json.loads(f.read(header_size - HEADER.size).rstrip('\0'))
+        f.close()
+        self.channels = self.meta['channels']
+        self.r = self.meta['r']
+        self.capacity = capacity
+        self.header = numpy.memmap(path, numpy.uint64, 'r', COUNT_OFFSET, 1)
+        self.ring = numpy.memmap(path, record_dtype(len(self.channels)), 'r',
+                                 header_size, capacity)
+
+    def count(self):
+        # Scans written so far, including any overwritten ones. Re-read on
+        # every call so a file still being written can be followed.
+        return int(self.header[0])
+
+    def segments(self):
+        # The retained records, oldest first, as one or two views into the
+        # mapped file.
+        count = self.count()
+        if count <= self.capacity:
+            return [self.ring[:count]]
+        i = count % self.capacity
+        return [self.ring[i:], self.ring[:i]]
+
+    def records(self):
+        # As segments(), copying only if the ring has wrapped.
+        segments = self.segments()
+        if len(segments) == 1:
+            return segments[0]
+        return numpy.concatenate(segments)
+
+    def decode(self, records=None):
+        # Returns (times, ina226.scans) in volts, amps and watts, NaN for
+        # failed reads.
+        if records is None:
+            records = self.records()
+        return records['t'], ina226.units(self.channels, records['shunt'], records['bus'],
+                                          self.r, records['failed'])
+
+def dump(t, scans, r, f=sys.stdout):
+    for i in range(0, len(t)):
+        line = ['{:.6f}'.format(t[i])]
+        for j, r_j in enumerate(r):
+            if r_j is None:
+                line += ['{:g}'.format(scans.bus[i, j]), '{:g}'.format(scans.shunt[i, j])]
+            else:
+                line += ['{:g}'.format(scans.bus[i, j]), '{:g}'.format(scans.current[i, j]),
+                         '{:g}'.format(scans.power[i, j])]
+        f.write(' '.join(line) + '\n')
+    f.flush()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', type=str)
+    parser.add_argument('-d', '--dump', action="store_true")
+    parser.add_argument('-f', '--follow', action="store_true")
+    parser.add_argument('-b', '--batch', type=int, default=64)
+    args = parser.parse_args()
+
+    f = reader(args.file)
+    print '# ' + json.dumps(f.meta, sort_keys=True)
+    print '# {} scans written, {} retained'.format(f.count(), min(f.count(), f.capacity))
+    if args.dump or args.follow:
+        names = ['time']
+        for chan, r in zip(f.channels, f.r):
+            if r is None:
+                names += [chan + '.V', chan + '.Vshunt']
+            else:
+                names += [chan + '.V', chan + '.A', chan + '.W']
+        print '# ' + ' '.join(names)
+    if args.dump:
+        t, scans = f.decode()
+        dump(t, scans, f.r)
+    if args.follow:
+        # Print scans as they are written, see pipeline.py. --batch is the
+        # most scans the writer appends at once.
+        import pipeline
+        follower = pipeline.follower(args.file, args.batch, f.count())
+        try:
+            while True:
+                overruns = follower.overruns
+                records = follower.read()
+                if follower.overruns != overruns:
+                    print '# overrun, {} scans lost'.format(follower.overruns - overruns)
+                if len(records):
+                    t, scans = f.decode(records)
+                    dump(t, scans, f.r)
+                else:
+                    time.sleep(0.01)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Min/max/mean decimation pyramid of a scan stream. Level k holds one
+# bucket per 2**k scans with the time span, the per channel count of
+# valid (not failed) samples and the min, max and mean of the shunt
+# voltage, bus voltage and power of every channel. Levels below base are
+# left to the raw capture. Buckets are built incrementally as scans come
+# in and appended to one file per level in a directory, normally the
+# capture file's name with .pyr added, see pyramid_path().
+#
+# An envelope query bisects the finest level for the window and reads
+# the level that gives about the asked for number of buckets, so its cost
+# does not grow with the capture.
+
+import argparse
+import json
+import math
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+QUANTITIES = ['shunt', 'bus', 'power']
+
+def pyramid_path(capture_path):
+    return capture_path + '.pyr'
+
+def bucket_dtype(n):
+    q = len(QUANTITIES)
+    return numpy.dtype([('t0', '<f8'), ('t1', '<f8'), ('n', '<u4'), ('valid', '<u4', (n,)),
+                        ('min', '<f4', (q, n)), ('max', '<f4', (q, n)), ('mean', '<f4', (q, n))])
+
+def level_path(path, level):
+    return os.path.join(path, '{:02d}.bin'.format(level))
+
+def merge(a, b):
+    # Combine the buckets of a with the following ones of b.
+    ret = numpy.empty(len(a), dtype=a.dtype)
+    ret['t0'] = a['t0']
+    ret['t1'] = b['t1']
+    ret['n'] = a['n'] + b['n']
+    ret['valid'] = a['valid'] + b['valid']
+    ret['min'] = numpy.fmin(a['min'], b['min'])
+    ret['max'] = numpy.fmax(a['max'], b['max'])
+    wa = a['valid'][:, None, :].astype(numpy.float64)
+    wb = b['valid'][:, None, :].astype(numpy.float64)
+    total = numpy.nan_to_num(a['mean']) * wa + numpy.nan_to_num(b['mean']) * wb
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = total / (wa + wb)
+    mean[numpy.isnan(a['mean']) & numpy.isnan(b['mean'])] = numpy.nan
+    ret['mean'] = mean
+    return ret
+
+class pyramid(object):
+    # Build the pyramid of scans of channels in the directory path. r
+    # holds each channel's shunt value or None, kept so readers can give
+    # current.
+    def __init__(self, path, channels, r, base=6):
+        if numpy is None:
+            raise Exception("numpy is required for decimation")
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in os.listdir(path):
+            os.unlink(os.path.join(path, name))
+        with open(os.path.join(path, 'meta.json'), 'wb') as f:
+            json.dump(dict(channels=list(channels), r=list(r), base=base,
+                           quantities=QUANTITIES), f)
+        self.path = path
+        self.channels = list(channels)
+        self.base = base
+        self.dtype = bucket_dtype(len(channels))
+        self.files = []
+        # Scans not making up a full base level bucket yet, and per level
+        # a bucket still waiting for its pair.
+        self.t = []
+        self.values = []
+        self.carry = []
+
+    def add(self, t, record):
+        # One record of pmc.sample values, as yielded by pmc.stream().
+        self.t.append(t)
+        row = []
+        for chan in self.channels:
+            s = record[chan]
+            row.append((s.shunt, s.bus, numpy.nan if s.power is None else s.power))
+        self.values.append(row)
+        if len(self.t) == 1 << self.base:
+            self.flush()
+
+    def add_scans(self, t, scans):
+        # (samples x channels) arrays, an ina226.scans.
+        values = numpy.dstack((scans.shunt, scans.bus, scans.power))
+        self.t.extend(numpy.asarray(t, dtype=numpy.float64))
+        self.values.extend(values)
+        if len(self.t) >= 1 << self.base:
+            self.flush()
+
+    def flush(self):
+        size = 1 << self.base
+        m = len(self.t) // size
+        if not m:
+            return
+        t = numpy.array(self.t[:m * size], dtype=numpy.float64).reshape(m, size)
+        # (buckets, scans, quantities, channels)
+        v = numpy.array(self.values[:m * size], dtype=numpy.float64)
+        v = v.reshape(m, size, len(self.channels), len(QUANTITIES)).transpose(0, 1, 3, 2)
+        del self.t[:m * size]
+        del self.values[:m * size]
+
+        buckets = numpy.empty(m, dtype=self.dtype)
+        buckets['t0'] = t[:, 0]
+        buckets['t1'] = t[:, -1]
+        buckets['n'] = size
+        ok = ~numpy.isnan(v[:, :, 1, :])
+        buckets['valid'] = ok.sum(axis=1)
+        buckets['min'] = numpy.fmin.reduce(v, axis=1)
+        buckets['max'] = numpy.fmax.reduce(v, axis=1)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            buckets['mean'] = numpy.nansum(v, axis=1) / (~numpy.isnan(v)).sum(axis=1)
+        self.append(0, buckets)
+
+    def append(self, i, buckets):
+        # Write buckets to level base + i and carry pairs upwards.
+        while len(buckets):
+            if i == len(self.files):
+                self.files.append(open(level_path(self.path, self.base + i), 'ab'))
+                self.carry.append(None)
+            self.files[i].write(buckets.tobytes())
+            self.files[i].flush()
+            if self.carry[i] is not None:
+                buckets = numpy.concatenate((self.carry[i], buckets))
+            odd = len(buckets) % 2
+            self.carry[i] = buckets[-1:] if odd else None
+            buckets = buckets[:len(buckets) - odd]
+            buckets = merge(buckets[0::2], buckets[1::2])
+            i += 1
+
+    def close(self):
+        # Scans short of a full bucket are left to the raw capture.
+        for f in self.files:
+            f.close()
+        self.files = []
+
+def feed(blocks, pyr):
+    # Pass (times, ina226.scans) blocks through, adding them to pyr.
+    try:
+        for t, scans in blocks:
+            pyr.add_scans(t, scans)
+            yield t, scans
+    finally:
+        pyr.close()
+
+class reader(object):
+    def __init__(self, path):
+        if numpy is None:
+            raise Exception("numpy is required for decimation")
+        with open(os.path.join(path, 'meta.json'), 'rb') as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.channels = self.meta['channels']
+        self.r = self.meta['r']
+        self.base = self.meta['base']
+        self.dtype = bucket_dtype(len(self.channels))
+
+    def level(self, k):
+        # The buckets of level k written so far, mapped. Re-read on every
+        # call so a pyramid still being built can be followed.
+        path = level_path(self.path, k)
+        n = os.path.getsize(path) // self.dtype.itemsize if os.path.exists(path) else 0
+        if not n:
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.memmap(path, self.dtype, 'r', 0, n)
+
+    def buckets(self, t1, t2, points=1000):
+        # Buckets overlapping [t1, t2], from the finest level giving no
+        # more than points of them if there is one. The newest scans not
+        # yet making up a bucket of that level are left out.
+        base = self.level(self.base)
+        first = numpy.searchsorted(base['t1'], t1)
+        last = numpy.searchsorted(base['t0'], t2, 'right')
+        k = 0
+        if last - first > points:
+            k = int(math.ceil(math.log(float(last - first) / points, 2)))
+        while k:
+            level = self.level(self.base + k)
+            if len(level):
+                break
+            k -= 1
+        else:
+            level = base
+        return level[first >> k:(last + (1 << k) - 1) >> k]
+
+    def envelope(self, t1, t2, points=1000, channel=None):
+        # (t0, t1, min, max, mean) of each bucket over [t1, t2], values are
+        # (buckets x channels) dicts of shunt, bus, current and power, or
+        # buckets long for a single channel.
+        b = self.buckets(t1, t2, points)
+        cols = slice(None) if channel is None else self.channels.index(channel)
+        r = numpy.array([numpy.nan if v is None else v for v in self.r], dtype=numpy.float64)
+        ret = []
+        for stat in ('min', 'max', 'mean'):
+            values = dict((q, b[stat][:, i, :].astype(numpy.float64))
+                          for i, q in enumerate(QUANTITIES))
+            values['current'] = values['shunt'] / r
+            ret.append(dict((q, v[:, cols]) for q, v in values.items()))
+        return b['t0'], b['t1'], ret[0], ret[1], ret[2]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', type=str, help="capture file")
+    parser.add_argument('-c', '--channel', type=str, required=False)
+    parser.add_argument('-q', '--quantity', type=str, default='power',
+                        choices=['shunt', 'bus', 'current', 'power'])
+    parser.add_argument('-p', '--points', type=int, default=1000)
+    parser.add_argument('--from', dest='start', type=float, required=False)
+    parser.add_argument('--to', dest='end', type=float, required=False)
+    parser.add_argument('--build', action="store_true")
+    parser.add_argument('--base', type=int, default=6)
+    args = parser.parse_args()
+
+    if args.build:
+        # Build the pyramid of an existing capture file.
+        import capture
+        f = capture.reader(args.file)
+        pyr = pyramid(pyramid_path(args.file), f.channels, f.r, args.base)
+        for segment in f.segments():
+            for i in range(0, len(segment), 65536):
+                t, scans = f.decode(segment[i:i + 65536])
+                pyr.add_scans(t, scans)
+        pyr.close()
+
+    pyr = reader(pyramid_path(args.file))
+    start = -numpy.inf if args.start is None else args.start
+    end = numpy.inf if args.end is None else args.end
+    t0, t1, lo, hi, mean = pyr.envelope(start, end, args.points, args.channel)
+    channels = [args.channel] if args.channel else pyr.channels
+    print '# t0 t1 ' + ' '.join('{0}.min {0}.max {0}.mean'.format(chan) for chan in channels)
+    for i in range(0, len(t0)):
+        line = ['{:.6f}'.format(t0[i]), '{:.6f}'.format(t1[i])]
+        for j in range(0, len(channels)):
+            v = [s[args.quantity][i] if args.channel else s[args.quantity][i, j]
+                 for s in (lo, hi, mean)]
+            line += ['{:g}'.format(x) for x in v]
+        print ' '.join(line)
@@ -0,0 +1,492 @@
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Software stand-in for a PMC-17 board, usable as the port of i2c_ftdi.
+# The MPSSE command stream is interpreted down to SCL/SDA edges which
+# drive an I2C bus of INA226 models. Time is simulated: MPSSE clocks
+# advance the device clock and every USB transfer costs a fixed latency.
+
+import collections
+import ftdi
+import time
+
+CONVERSION_TIMES = [140e-6, 204e-6, 332e-6, 588e-6, 1100e-6, 2116e-6, 4156e-6, 8244e-6]
+AVERAGES = [1, 4, 16, 64, 128, 256, 512, 1024]
+
+class ina226(object):
+    def __init__(self, source):
+        # source(t) returns the (shunt, bus) voltages seen at time t.
+        self.source = source
+        self.pointer = 0
+        self.regs = {0: 0x4127, 5: 0, 6: 0, 7: 0, 0xfe: 0x5449, 0xff: 0x2260}
+        self.rx = []
+        self.tx = []
+        # Powered up long before the host attached, results are ready.
+        self.conv_start = -1.0
+        self.shunt = 0
+        self.bus = 0
+        self.cvrf_read = 0.0
+
+    def timing(self):
+        config = self.regs[0]
+        avg = AVERAGES[(config >> 9) & 7]
+        vbus = CONVERSION_TIMES[(config >> 6) & 7]
+        vsh = CONVERSION_TIMES[(config >> 3) & 7]
+        mode = config & 7
+        return avg, vsh if mode & 1 else 0, vbus if mode & 2 else 0, mode
+
+    def convert(self, now):
+        # Update the result registers with every conversion finished by now.
+        avg, vsh, vbus, mode = self.timing()
+        if not mode & 3:
+            return None
+        period = avg * (vsh + vbus)
+        elapsed = now - self.conv_start
+        if mode & 4:
+            n = int(elapsed / period)
+            if not n:
+                return None
+            done = self.conv_start + n * period
+        else:
+            if elapsed < period:
+                if avg == 1 and vsh and elapsed >= vsh:
+                    self.shunt = self.sample(self.conv_start + vsh)[0]
+                return None
+            done = self.conv_start + period
+        shunt, bus = self.sample(done)
+        if vsh:
+            self.shunt = shunt
+        if vbus:
+            self.bus = bus
+        return done
+
+    def sample(self, t):
+        shunt, bus = self.source(t)
+        shunt = int(round(shunt * 400000))
+        shunt = max(-0x8000, min(0x7fff, shunt)) & 0xffff
+        bus = max(0, min(0x7fff, int(round(bus * 800))))
+        return shunt, bus
+
+    def reg(self, n, now):
+        done = self.convert(now)
+        if n == 1:
+            return self.shunt
+        if n == 2:
+            return self.bus
+        if n == 3:
+            return (self.reg(4, now) * self.bus / 20000) & 0xffff
+        if n == 4:
+            shunt = self.shunt - 0x10000 if self.shunt & 0x8000 else self.shunt
+            return (shunt * self.regs[5] / 2048) & 0xffff
+        if n == 6:
+            val = self.regs[6] & ~0x8
+            if done is not None and done > self.cvrf_read:
+                val |= 0x8
+            self.cvrf_read = now
+            return val
+        return self.regs.get(n, 0)
+
+    def alert(self, now):
+        # ALERT is open drain and active low unless APOL is set.
+        if not self.regs[6] & 0x400:
+            return False
+        done = self.convert(now)
+        return done is not None and done > self.cvrf_read
+
+    def start(self, read, now):
+        self.rx = []
+        if read:
+            val = self.reg(self.pointer, now)
+            self.tx = [val >> 8, val & 0xff]
+
+    def write_byte(self, b, now):
+        self.rx.append(b)
+        if len(self.rx) == 1:
+            self.pointer = b
+        elif len(self.rx) == 3:
+            val = self.rx[1] << 8 | self.rx[2]
+            if self.pointer == 0:
+                self.convert(now)
+                if val & 0x8000:
+                    val = 0x4127
+                self.regs[0] = val
+                self.conv_start = now
+                self.cvrf_read = now
+            elif self.pointer in (5, 6, 7):
+                self.regs[self.pointer] = val
+
+    def read_byte(self, now):
+        if not self.tx:
+            val = self.reg(self.pointer, now)
+            self.tx = [val >> 8, val & 0xff]
+        return self.tx.pop(0)
+
+    def stop(self, now):
+        pass
+
+class i2c_bus(object):
+    # Pin level I2C target state machine shared by all devices on the bus.
+    def __init__(self):
+        self.devices = dict()
+        self.scl = 1
+        self.master = 1
+        self.slave = 1
+        self.state = 'idle'
+        self.selected = None
+        self.shift = 0
+        self.n = 0
+        self.read = False
+        self.byte = 0
+
+    def add(self, addr, dev):
+        self.devices[addr] = dev
+
+    def line(self):
+        return self.master & self.slave
+
+    def update(self, scl, sda, now):
+        # Data changes before a rising edge and after a falling one.
+        if scl and not self.scl:
+            self.set_sda(sda, now)
+            self.scl = 1
+            self.rise()
+        elif not scl and self.scl:
+            self.scl = 0
+            self.fall(now)
+            self.set_sda(sda, now)
+        else:
+            self.set_sda(sda, now)
+        return self.line()
+
+    def clock(self, sda, now):
+        # One clocked data bit, returns the level sampled on the rising edge.
+        self.update(0, sda, now)
+        ret = self.update(1, sda, now)
+        self.update(0, sda, now)
+        return ret
+
+    def set_sda(self, sda, now):
+        before = self.line()
+        self.master = sda
+        if self.scl and before != self.line():
+            if self.line():
+                if self.selected is not None:
+                    self.selected.stop(now)
+                self.selected = None
+                self.state = 'idle'
+            else:
+                self.state = 'addr'
+                self.shift = 0
+                self.n = 0
+            self.slave = 1
+
+    def rise(self):
+        b = self.line()
+        if self.state in ('addr', 'rx'):
+            self.shift = (self.shift << 1 | b) & 0xff
+            self.n += 1
+        elif self.state == 'tx':
+            self.n += 1
+        elif self.state == 'mack':
+            self.shift = b
+
+    def drive(self):
+        self.slave = (self.byte >> (7 - self.n)) & 1
+
+    def fall(self, now):
+        if self.state == 'addr' and self.n == 8:
+            self.selected = self.devices.get(self.shift >> 1)
+            self.read = bool(self.shift & 1)
+            if self.selected is None:
+                self.state = 'idle'
+            else:
+                self.selected.start(self.read, now)
+                self.state = 'ack'
+                self.slave = 0
+        elif self.state == 'rx' and self.n == 8:
+            self.selected.write_byte(self.shift, now)
+            self.state = 'ack'
+            self.slave = 0
+        elif self.state == 'ack':
+            self.n = 0
+            self.shift = 0
+            if self.read:
+                self.state = 'tx'
+                self.byte = self.selected.read_byte(now)
+                self.drive()
+            else:
+                self.state = 'rx'
+                self.slave = 1
+        elif self.state == 'tx':
+            if self.n == 8:
+                self.state = 'mack'
+                self.slave = 1
+            else:
+                self.drive()
+        elif self.state == 'mack':
+            if self.shift:
+                self.state = 'idle'
+            else:
+                self.state = 'tx'
+                self.n = 0
+                self.byte = self.selected.read_byte(now)
+                self.drive()
+
+class pmc17(object):
+    # The board: a direct INA226 at 0x4e on the DC input, one at 0x4f
+    # behind a 16 channel analog mux addressed by GPIO, and any extra
+    # devices added to bus. channels holds a (shunt, bus) pair or a
+    # function of time for each mux input.
+    def __init__(self, addrs, alert, channels=None, dc_in=None):
+        self.addrs = addrs
+        self.alert_pin = alert
+        self.pins = 0xffff
+        if channels is None:
+            channels = [((i + 1) * 100e-6, 1.0 + 0.1 * i) for i in range(0, 16)]
+        self.channels = channels
+        self.dc_in = (5e-3, 5.0) if dc_in is None else dc_in
+        self.bus = i2c_bus()
+        self.add(0x4e, ina226(lambda t: self.value(self.dc_in, t)))
+        self.add(0x4f, ina226(lambda t: self.value(self.channels[self.mux()], t)))
+
+    def add(self, addr, dev):
+        self.bus.add(addr, dev)
+
+    def populate(self, addr):
+        # Fit a fixed value INA226 at addr unless something is there.
+        if addr not in self.bus.devices:
+            self.add(addr, ina226(lambda t: ((addr & 0xf) * 1e-4 + 1e-4, 1.2)))
+
+    def value(self, v, t):
+        return v(t) if callable(v) else v
+
+    def mux(self):
+        ret = 0
+        for i in range(0, 4):
+            ret |= ((self.pins >> self.addrs[i]) & 1) << i
+        return ret
+
+    def outputs(self, pins, now):
+        self.pins = pins
+
+    def inputs(self, now):
+        # Undriven inputs are pulled up.
+        ret = 0xffff
+        for dev in self.bus.devices.values():
+            if dev.alert(now):
+                ret &= ~(1 << self.alert_pin)
+        return ret
+
+class port(object):
+    def __init__(self, board, scl=0, sda_out=1, sda_in=2, latency=125e-6,
+                 tx_size=4096, rx_size=4096, realtime=False):
+        self.board = board
+        self.scl = scl
+        self.sda_out = sda_out
+        self.sda_in = sda_in
+        self.latency = latency
+        self.tx_size = tx_size
+        self.rx_size = rx_size
+        self.realtime = realtime
+        self.gpio = 0xffff
+        self.dir = 0
+        self.base = 6000000
+        self.hz = self.base
+        self.three_phase = False
+        self.pending = bytearray()
+        self.rx = collections.deque()
+        self.now = 0.0
+        self.host = 0.0
+        self.wall = time.time()
+        self.writes = 0
+        self.reads = 0
+        self.written = 0
+        self.read_bytes = 0
+
+    def set_bitmode(self, mask, mode):
+        self.dir = mask
+        return 0
+
+    def pins(self):
+        inputs = self.board.inputs(self.now)
+        ret = (self.gpio & self.dir) | (inputs & ~self.dir)
+        ret &= ~(1 << self.sda_in)
+        ret |= self.board.bus.line() << self.sda_in
+        return ret & 0xffff
+
+    def master_sda(self):
+        if self.dir & (1 << self.sda_out):
+            return (self.gpio >> self.sda_out) & 1
+        return 1
+
+    def set_bits(self, val, direction, high):
+        shift = 8 if high else 0
+        self.gpio = (self.gpio & ~(0xff << shift)) | (val << shift)
+        self.dir = (self.dir & ~(0xff << shift)) | (direction << shift)
+        scl = (self.gpio >> self.scl) & 1 if self.dir & (1 << self.scl) else 1
+        self.board.bus.update(scl, self.master_sda(), self.now)
+        self.board.outputs(self.gpio & self.dir, self.now)
+
+    def bit_time(self):
+        return (1.5 if self.three_phase else 1.0) / self.hz
+
+    def respond(self, b):
+        if len(self.rx) >= self.rx_size:
+            raise Exception("Simulated RX FIFO overrun, the MPSSE engine would stall")
+        self.rx.append((b, self.now))
+
+    def shift(self, op, nbits, data):
+        ret = []
+        mask = 1 << self.sda_out
+        for i in range(0, nbits):
+            if op & ftdi.MPSSE_DO_WRITE:
+                byte = data[i / 8]
+                pos = i % 8 if op & ftdi.MPSSE_LSB else 7 - i % 8
+                b = (byte >> pos) & 1
+                self.gpio = (self.gpio & ~mask) | (b << self.sda_out)
+            ret.append(self.board.bus.clock(self.master_sda(), self.now))
+            self.now += self.bit_time()
+        self.gpio &= ~(1 << self.scl)
+        if op & ftdi.MPSSE_DO_READ:
+            for i in range(0, nbits, 8):
+                val = 0
+                for b in ret[i:i + 8]:
+                    val = val << 1 | b
+                self.respond(val)
+
+    def execute(self, data):
+        # Run every complete command, returns the number of bytes used. The
+        # engine stalls on a command whose response the RX FIFO has no
+        # room for until the host reads.
+        i = 0
+        while i < len(data):
+            op = data[i]
+            avail = len(data) - i
+            if op in (ftdi.SET_BITS_LOW, ftdi.SET_BITS_HIGH):
+                if avail < 3:
+                    break
+                self.set_bits(data[i + 1], data[i + 2], op == ftdi.SET_BITS_HIGH)
+                i += 3
+            elif op in (ftdi.GET_BITS_LOW, ftdi.GET_BITS_HIGH):
+                if len(self.rx) >= self.rx_size:
+                    break
+                self.respond((self.pins() >> (8 if op == ftdi.GET_BITS_HIGH else 0)) & 0xff)
+                i += 1
+            elif op == ftdi.TCK_DIVISOR:
+                if avail < 3:
+                    break
+                div = data[i + 1] | data[i + 2] << 8
+                self.hz = self.base / (div + 1)
+                i += 3
+            elif op in (ftdi.DIS_DIV_5, ftdi.EN_DIV_5):
+                self.base = 30000000 if op == ftdi.DIS_DIV_5 else 6000000
+                i += 1
+            elif op in (ftdi.EN_3_PHASE, ftdi.DIS_3_PHASE):
+                self.three_phase = op == ftdi.EN_3_PHASE
+                i += 1
+            elif op in (ftdi.EN_ADAPTIVE, ftdi.DIS_ADAPTIVE, ftdi.SEND_IMMEDIATE):
+                i += 1
+            elif op == ftdi.CLK_BITS:
+                if avail < 2:
+                    break
+                self.shift(op, data[i + 1] + 1, None)
+                i += 2
+            elif op == ftdi.CLK_BYTES:
+                if avail < 3:
+                    break
+                self.now += ((data[i + 1] | data[i + 2] << 8) + 1) * 8 * self.bit_time()
+                i += 3
+            elif op in (ftdi.WAIT_ON_HIGH, ftdi.WAIT_ON_LOW):
+                # Waits on GPIOL1, step in bit times until it matches.
+                want = op == ftdi.WAIT_ON_HIGH
+                limit = self.now + 1.0
+                while bool((self.pins() >> 5) & 1) != want:
+                    if self.now > limit:
+                        raise Exception("Simulated MPSSE wait never completed")
+                    self.now += self.bit_time()
+                i += 1
+            elif op in (0xaa, 0xab):
+                # Bad commands, echoed after 0xfa. Hosts use them to find
+                # the end of stale responses.
+                if len(self.rx) + 2 > self.rx_size:
+                    break
+                self.respond(0xfa)
+                self.respond(op)
+                i += 1
+            elif op & 0x80 == 0 and op & (ftdi.MPSSE_DO_WRITE | ftdi.MPSSE_DO_READ):
+                head = 2 if op & ftdi.MPSSE_BITMODE else 3
+                if avail < head:
+                    break
+                if op & ftdi.MPSSE_BITMODE:
+                    nbits = data[i + 1] + 1
+                    nbytes = 1
+                else:
+                    nbytes = (data[i + 1] | data[i + 2] << 8) + 1
+                    nbits = nbytes * 8
+                need = head + (nbytes if op & ftdi.MPSSE_DO_WRITE else 0)
+                if avail < need:
+                    break
+                if op & ftdi.MPSSE_DO_READ and self.rx and len(self.rx) + nbytes > self.rx_size:
+                    break
+                wr = data[i + head:i + need]
+                i += need
+                self.shift(op, nbits, wr)
+            else:
+                raise Exception("Unsupported MPSSE command", hex(op))
+            # Command decode takes a few 60MHz cycles per byte.
+            self.now += 3 / 60e6
+        return i
+
+    def sync(self):
+        if self.realtime:
+            delay = self.wall + self.host - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def run(self):
+        # Resume the engine on the TX FIFO, not before the host got to it.
+        self.now = max(self.now, self.host)
+        used = self.execute(self.pending)
+        del self.pending[:used]
+
+    def write(self, buf):
+        # A real write blocks while the TX FIFO is full, here that can only
+        # be an engine stalled on a full RX FIFO, which would never drain
+        # as the host is not reading.
+        self.writes += 1
+        self.written += len(buf)
+        self.host += self.latency
+        self.pending += buf
+        self.run()
+        if len(self.pending) > self.tx_size:
+            raise Exception("Simulated TX FIFO full with the RX FIFO full, the write would time out")
+        self.sync()
+        return len(buf)
+
+    def read(self, buf, size):
+        if not self.rx:
+            if self.pending:
+                raise Exception("Simulated read stalled on a partial MPSSE command")
+            raise Exception("Simulated read with no response pending, would hang")
+        n = min(size, len(self.rx))
+        for i in range(0, n):
+            buf[i], t = self.rx.popleft()
+        self.reads += 1
+        self.read_bytes += n
+        self.host = max(self.host, t) + self.latency
+        if self.pending:
+            self.run()
+        self.sync()
+        return n
+
+    def elapsed(self):
+        return self.host
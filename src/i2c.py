@@ -10,14 +10,34 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
 # Lesser General Public License for more details.
 
+import contextlib
+
 I2C_M_NOSTART = 0x01
 I2C_M_RD = 0x02
 I2C_M_RECV_LEN = 0x04
 I2C_SMBUS_BLOCK_MAX = 0x20
 
+class deferred(object):
+    # Result of an SMBus read queued in a batch. get() flushes the queue
+    # unless that already happened.
+    __slots__ = ('bus', 'buf', 'decode', 'flushes')
+
+    def __init__(self, bus, buf, decode):
+        self.bus = bus
+        self.buf = buf
+        self.decode = decode
+        self.flushes = bus.flushes
+
+    def get(self):
+        if self.bus.flushes == self.flushes:
+            self.bus.flush()
+        return self.decode(self.buf)
+
 class i2c(object):
     def __init__(self, hw):
         self.hw = hw
+        self.batching = 0
+        self.flushes = 0
 
     def fill_recv_len(self, rlen):
         self.recv_len = rlen
@@ -28,9 +48,46 @@ class i2c(object):
         return append
 
     def xfer(self, *msgs):
+        # The ACKs of a transfer with a block read are tagged with a tag of
+        # its own, earlier NACKs in the same flush belong to others.
+        tag = self.hw.tag
+        if any(flags & I2C_M_RD and (flags & I2C_M_RECV_LEN or rlen is None)
+               for addr, flags, buf, rlen in msgs):
+            self.hw.tag = object()
+        try:
+            self.queue_xfer(msgs)
+        finally:
+            self.hw.tag = tag
+
+    def read_len(self):
+        # The length decides how much more to read, this costs a round trip
+        # even inside a batch. Whatever goes wrong, the read is ended with
+        # a NACK and a stop before raising. A NACK of the transfer raises
+        # the same error as an untagged one.
+        own = self.hw.tag
+        self.hw.inb(self.fill_recv_len)
+        try:
+            self.flush()
+        except:
+            self.hw.acknak(False)
+            self.hw.stop()
+            self.flush()
+            raise
+        nacked = own in self.hw.failed
+        self.hw.failed.discard(own)
+        if nacked or self.hw.hw_error or self.recv_len > I2C_SMBUS_BLOCK_MAX:
+            self.hw.acknak(False)
+            self.hw.stop()
+            self.flush()
+            if nacked:
+                raise Exception("I2C error")
+            if self.hw.hw_error:
+                raise Exception("USB error", self.hw.hw_error)
+            raise Exception("Bad SMBus block length", self.recv_len)
+
+    def queue_xfer(self, msgs):
         self.hw.start()
         first_msg = True
-        self.hw.start()
         for msg in msgs:
             addr, flags, buf, rlen = msg
             if not flags & I2C_M_NOSTART:
@@ -39,14 +96,10 @@ class i2c(object):
                 self.hw.outb((addr << 1) | (1 if (flags & I2C_M_RD) else 0))
             if flags & I2C_M_RD:
                 if flags & I2C_M_RECV_LEN or rlen is None:
-                    self.hw.inb(self.fill_recv_len)
-                    self.flush()
-                    if self.hw.i2c_error or self.recv_len > I2C_SMBUS_BLOCK_MAX:
-                        self.hw.acknak(False)
-                        raise error()
-                    self.hw.acknak(recv_len == 0)
+                    self.read_len()
+                    self.hw.acknak(self.recv_len != 0)
                     buf.append(self.recv_len)
-                    rlen = self.rec_len
+                    rlen = self.recv_len
 
                 for i in range(0, rlen):
                     self.hw.inb(self.make_buf(buf))
@@ -58,7 +111,64 @@ class i2c(object):
         self.hw.stop()
 
     def flush(self):
-        self.hw.flush_all()
+        try:
+            self.hw.flush_all()
+        finally:
+            if self.batching:
+                # Only what is queued from here on can be dropped.
+                self.point = self.hw.checkpoint()
+        self.flushes += 1
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Within the block SMBus helpers only queue their transfer, reads
+        # return a deferred. Everything is flushed together at the end,
+        # or when a deferred's value is first needed. Batches nest. If the
+        # block raises, whatever the batch left unflushed is dropped.
+        if not self.batching:
+            self.point = self.hw.checkpoint()
+        self.batching += 1
+        try:
+            yield self
+        except:
+            if self.batching == 1:
+                self.hw.rewind(self.point)
+            raise
+        finally:
+            self.batching -= 1
+        if not self.batching:
+            self.flush()
+
+    def finish(self, buf=None, decode=None):
+        # Flush a helper's transfer unless batching. Returns the decoded
+        # read, or its deferred when batching.
+        if self.batching:
+            return None if decode is None else deferred(self, buf, decode)
+        self.flush()
+        return None if decode is None else decode(buf)
+
+    def compile(self, *msgs):
+        # Record an xfer as a replayable program. Instead of data, the read
+        # buffers in msgs are filled with offsets into the program response.
+        self.hw.record()
+        self.xfer(*msgs)
+        return self.hw.compile()
+
+    def instrument(self, enable=True):
+        # As i2c_ftdi.instrument(), also counting transactions.
+        self.__dict__.pop('xfer', None)
+        c = self.hw.instrument(enable)
+        if c is not None:
+            xfer = self.xfer
+            def counted_xfer(*msgs):
+                if self.hw.recording is None:
+                    c.transactions += 1
+                xfer(*msgs)
+            self.xfer = counted_xfer
+        return c
+
+    def replay(self, prog, func):
+        self.hw.replay(prog, func)
 
     def master_send(self, addr, buf):
         self.xfer((addr, 0, buf, None))
@@ -68,54 +178,49 @@ class i2c(object):
 
     def probe_func_quick_read(self, addr):
         self.xfer((addr, I2C_M_RD, None, 0))
-        self.flush()
+        self.finish()
 
     def smbus_read_byte(self, addr):
         buf = []
         self.xfer((addr, I2C_M_RD, buf, 1))
-        self.flush()
-        return buf[0]
+        return self.finish(buf, lambda buf: buf[0])
 
     def smbus_write_byte(self, addr, val):
         self.xfer((addr, 0, [val], None))
-        self.flush()
+        self.finish()
 
     def smbus_read_byte_data(self, addr, cmd):
         buf = []
         self.xfer((addr, 0, [cmd], None), (addr, I2C_M_RD, buf, 1))
-        self.flush()
-        return buf[0]
+        return self.finish(buf, lambda buf: buf[0])
 
     def smbus_write_byte_data(self, addr, cmd, val):
         self.xfer((addr, 0, [cmd, val], None))
-        self.flush()
+        self.finish()
 
     def smbus_read_word_data(self, addr, cmd):
         buf = []
         self.xfer((addr, 0, [cmd], None), (addr, I2C_M_RD, buf, 2))
-        self.flush()
-        return buf[1] | buf[0] << 8
+        return self.finish(buf, lambda buf: buf[1] | buf[0] << 8)
 
     def smbus_write_word_data(self, addr, cmd, val):
         self.xfer((addr, 0, [cmd, val >> 8, val & 0xff], None))
-        self.flush()
+        self.finish()
 
     def smbus_read_block_data(self, addr, cmd):
         buf = []
         self.xfer((addr, 0, [cmd], None), (addr, I2C_M_RD, buf, None))
-        self.flush()
-        return buf[1:]
+        return self.finish(buf, lambda buf: buf[1:])
 
     def smbus_write_block_data(self, addr, cmd, buf):
         self.xfer((addr, 0, [cmd, len(buf)] + buf, None))
-        self.flush()
+        self.finish()
 
     def smbus_read_i2c_block_data(self, addr, cmd, rlen):
         buf = []
         self.xfer((addr, 0, [cmd], None), (addr, I2C_M_RD, buf, rlen))
-        self.flush()
-        return buf[1:]
+        return self.finish(buf, lambda buf: buf)
 
     def smbus_write_i2c_block_data(self, addr, cmd, buf):
         self.xfer((addr, 0, [cmd] + buf, None))
-        self.flush()
+        self.finish()
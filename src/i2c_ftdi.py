@@ -10,39 +10,223 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
 # Lesser General Public License for more details.
 
+import atexit
+import collections
 import ftdi
+import itertools
+import json
 import math
+import sys
+import threading
+import time
+
+# FT2232H per-channel FIFO sizes. A flush is cut into chunks no larger than
+# half of each so that one chunk can be executing while the next is queued
+# behind it without the MPSSE engine stalling on a full RX FIFO.
+TX_FIFO_SIZE = 4096
+RX_FIFO_SIZE = 4096
+
+# The MPSSE WAIT_ON_HIGH/WAIT_ON_LOW commands only watch GPIOL1 (ADBUS5).
+WAIT_GPIO = 5
+
+# An invalid MPSSE command, answered with BAD_COMMAND_REPLY and itself.
+BAD_COMMAND = 0xaa
+BAD_COMMAND_REPLY = 0xfa
+
+class ftdi_port(object):
+    # USB transport of i2c_ftdi. A port implements set_bitmode(), write()
+    # of a str and read() into a bytearray, ftdi_sim.port is a software
+    # stand-in.
+    def __init__(self, ftdic):
+        self.ftdic = ftdic
+        # libftdi fills a str in place, keep one around rather than
+        # allocating per read.
+        self.scratch = '\0' * RX_FIFO_SIZE
+
+    def set_bitmode(self, mask, mode):
+        return ftdi.ftdi_set_bitmode(self.ftdic, mask, mode)
+
+    def write(self, buf):
+        return ftdi.ftdi_write_data(self.ftdic, buf, len(buf))
+
+    def read(self, buf, size):
+        size = min(size, len(self.scratch))
+        ret = ftdi.ftdi_read_data(self.ftdic, self.scratch, size)
+        if ret > 0:
+            buf[0:ret] = memoryview(self.scratch)[0:ret]
+        return ret
+
+class counters(object):
+    # Instrumentation of an i2c_ftdi and its i2c, see i2c_ftdi.instrument().
+    # Bus time and delay ticks are on the i2c_ftdi elapsed timeline, so they
+    # include compiled programs, command counts only cover live commands
+    # and the data of replayed programs.
+    def __init__(self, hw):
+        self.hw = hw
+        self.reset()
+
+    def reset(self):
+        self.transactions = 0
+        self.cmds = 0
+        self.cmd_bytes = 0
+        self.replays = 0
+        self.usb_writes = 0
+        self.usb_write_bytes = 0
+        self.usb_write_time = 0.0
+        self.usb_reads = 0
+        self.usb_read_bytes = 0
+        self.usb_read_time = 0.0
+        self.nacks = 0
+        self.hw_errors = 0
+        self.start = (time.time(), time.clock(), self.hw.elapsed, self.hw.ticks)
+
+    def snapshot(self):
+        wall, cpu, elapsed, ticks = self.start
+        ret = dict((k, v) for k, v in vars(self).items() if k not in ('hw', 'start'))
+        ret['wall_time'] = time.time() - wall
+        ret['cpu_time'] = time.clock() - cpu
+        ret['bus_time'] = self.hw.elapsed - elapsed
+        ret['delay_ticks'] = self.hw.ticks - ticks
+        return ret
+
+    def write(self, f=sys.stderr):
+        f.write(json.dumps(self.snapshot(), sort_keys=True) + '\n')
+        f.flush()
+
+    def report(self, interval, f=sys.stderr):
+        # Write a snapshot every interval seconds from a background thread
+        # until the returned event is set, at the latest at exit.
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                self.write(f)
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        def finish():
+            stop.set()
+            t.join()
+        atexit.register(finish)
+        return stop
+
+class timed_port(object):
+    # Port wrapper timing the USB transfers of an instrumented i2c_ftdi.
+    def __init__(self, port, counters):
+        self.port = port
+        self.counters = counters
+
+    def set_bitmode(self, mask, mode):
+        return self.port.set_bitmode(mask, mode)
+
+    def write(self, buf):
+        t = time.time()
+        ret = self.port.write(buf)
+        c = self.counters
+        c.usb_write_time += time.time() - t
+        c.usb_writes += 1
+        c.usb_write_bytes += len(buf)
+        return ret
+
+    def read(self, buf, size):
+        t = time.time()
+        ret = self.port.read(buf, size)
+        c = self.counters
+        c.usb_read_time += time.time() - t
+        c.usb_reads += 1
+        c.usb_read_bytes += max(ret, 0)
+        return ret
+
+class ack(object):
+    # Response consumer of the ACK bit of a byte written in a transaction
+    # tagged tag, see i2c_ftdi.tag and i2c_ftdi.nack().
+    __slots__ = ('hw', 'tag')
+
+    def __init__(self, hw, tag):
+        self.hw = hw
+        self.tag = tag
+
+    def __call__(self, b):
+        if b & 1:
+            self.hw.nack(self.tag)
+
+class program(object):
+    # A frozen run of MPSSE commands recorded by i2c_ftdi.record() and
+    # i2c_ftdi.compile(). The response is delivered as one block of rd_len
+    # bytes, nacks holds the (offset, tag) of the ACK bits within it. The GPIO
+    # state is baked into the SET_BITS commands, so a program is only valid
+    # while the pins outside the I2C lines are where they were recorded.
+    # duration is the bus time the program takes, see i2c_ftdi.elapsed, of
+    # which ticks are delay clock bytes.
+    def __init__(self, data, rd_len, marks, nacks, state, end_state, duration, ticks):
+        self.data = data
+        self.rd_len = rd_len
+        self.marks = marks
+        self.nacks = nacks
+        self.state = state
+        self.end_state = end_state
+        self.duration = duration
+        self.ticks = ticks
+
+    def failed(self, data):
+        # Tags of the transactions NACKed in response data.
+        return set(tag for offset, tag in self.nacks if data[offset] & 1)
+
+    def matches(self, hw):
+        return hw.state() == self.state
 
 class i2c_ftdi(object):
-    def __init__(self, ftdic, scl, sda_out, sda_in, speed_hz, direction):
+    def __init__(self, port, scl, sda_out, sda_in, speed_hz, direction):
         direction |= (1 << scl) | (1 << sda_out)
         direction &= ~(1 << sda_in)
 
-        self.ftdic = ftdic
+        self.port = port
         self.scl = scl
         self.sda_out = sda_out
         self.dir = direction
         self.wr_buffer = bytearray()
-        self.dest = []
+        self.dest = collections.deque()
+        self.rd_len = 0
+        self.rd_block = bytearray()
+        self.recording = None
+        self.marks = []
+        self.tx_chunk = TX_FIFO_SIZE / 2
+        self.rx_chunk = RX_FIFO_SIZE / 2
+        self.rd_buffer = bytearray(RX_FIFO_SIZE)
         self.i2c_error = False
         self.hw_error = 0
+        # NACKs are collected while the whole response is drained. Tagged
+        # ones are left in failed for the caller, untagged ones make the
+        # flush raise once it is done.
+        self.tag = None
+        self.failed = set()
+        self.unhandled = 0
         self.gpio = 0
-
-        ret = ftdi.ftdi_set_bitmode(ftdic, direction & 0xff, ftdi.BITMODE_MPSSE)
+        # Last (value, direction) written to each byte, an update that would
+        # not change it is dropped. Writing data moves the SDA pin, so that
+        # forgets the low byte.
+        self.high = None
+        self.low = None
+        # Bus time of everything queued so far, in seconds. Only clocked
+        # commands are counted, so this is a lower bound of the real time.
+        self.elapsed = 0.0
+        self.ticks = 0
+        self.three_phase = False
+        self.counters = None
+
+        ret = port.set_bitmode(direction & 0xff, ftdi.BITMODE_MPSSE)
         if ret < 0:
             raise Exception("ftdi_set_bitmode failed", ret)
 
         self.cmd(ftdi.GET_BITS_LOW)
-        self.dest.append(lambda b: self.read_initial(b, False))
+        self.expect(lambda b: self.read_initial(b, False))
         self.cmd(ftdi.GET_BITS_HIGH)
-        self.dest.append(lambda b: self.read_initial(b, True))
+        self.expect(lambda b: self.read_initial(b, True))
         self.flush_all()
 
-        self.set_rate(speed_hz)
-
         self.cmd(ftdi.DIS_ADAPTIVE)
         self.cmd(ftdi.EN_3_PHASE)
         self.three_phase = True
+        self.set_rate(speed_hz)
         self.append_data_clock((1, 1))
 
         self.flush_all()
@@ -50,45 +234,286 @@ class i2c_ftdi(object):
     def read_initial(self, b, high):
         self.gpio |= (b << 8) if high else b
 
-    def flush_input(self):
-        while len(self.dest) and not self.hw_error:
-
-            data = chr(0)*len(self.dest)
-            ret = ftdi.ftdi_read_data(self.ftdic, data, len(self.dest))
+    def expect(self, func, n=None):
+        # Queue a consumer for the response stream. func is called with
+        # each byte, or with a bytearray once n bytes have arrived.
+        self.dest.append((n, func))
+        self.rd_len += 1 if n is None else n
+
+    def dispatch(self, ret):
+        rd = self.rd_buffer
+        dest = self.dest
+        i = 0
+        while i < ret:
+            n, func = dest[0]
+            if n is None:
+                dest.popleft()
+                func(rd[i])
+                i += 1
+                continue
+            take = min(n - len(self.rd_block), ret - i)
+            self.rd_block += rd[i:i + take]
+            i += take
+            if len(self.rd_block) == n:
+                dest.popleft()
+                data = self.rd_block
+                self.rd_block = bytearray()
+                func(data)
+
+    def flush_input(self, count=None):
+        if count is None:
+            count = self.rd_len
+        while count and not self.hw_error:
+
+            ret = self.port.read(self.rd_buffer, min(count, len(self.rd_buffer)))
             if ret < 0:
+                if self.counters is not None:
+                    self.counters.hw_errors += 1
                 self.hw_error = ret
                 self.i2c_error = True
                 break
 
-            for b in data[:ret]:
-                self.dest.pop(0)(ord(b))
+            count -= ret
+            self.rd_len -= ret
+            self.dispatch(ret)
 
-    def flush_output(self):
-        if self.hw_error or not len(self.wr_buffer):
+    def write(self, data):
+        if self.hw_error or not len(data):
             return
-        buf = None
-        for i in self.wr_buffer:
-            if buf is None:
-                buf = chr(i)
-            else:
-                buf += chr(i)
-        ret = ftdi.ftdi_write_data(self.ftdic, buf, len(self.wr_buffer))
+        # The libftdi binding only accepts a str, this is a single copy.
+        ret = self.port.write(str(data))
         if ret < 0:
+            if self.counters is not None:
+                self.counters.hw_errors += 1
             self.hw_error = ret
             self.i2c_error = True
+
+    def flush_output(self):
+        self.write(self.wr_buffer)
+        del self.wr_buffer[:]
+        self.marks = []
+
+    def resync(self, timeout=1.0):
+        # Start over after a flush was cut short. Everything queued is
+        # dropped and whatever is still in flight is read back and thrown
+        # away, up to the answer of a bad command sent behind it. The pins
+        # are written again by the next update.
+        self.recording = None
         self.wr_buffer = bytearray()
+        self.marks = []
+        self.dest.clear()
+        self.rd_len = 0
+        self.rd_block = bytearray()
+        self.unhandled = 0
+        self.high = None
+        self.low = None
+        self.write(bytearray((BAD_COMMAND, ftdi.SEND_IMMEDIATE)))
+        tail = bytearray()
+        deadline = time.time() + timeout
+        while tail != bytearray((BAD_COMMAND_REPLY, BAD_COMMAND)):
+            if self.hw_error:
+                raise Exception("USB error", self.hw_error)
+            if time.time() > deadline:
+                raise Exception("MPSSE engine did not answer a bad command")
+            ret = self.port.read(self.rd_buffer, len(self.rd_buffer))
+            if ret < 0:
+                self.hw_error = ret
+                continue
+            tail = (tail + self.rd_buffer[:ret])[-2:]
+
+    def mark(self):
+        # Record a point between transactions where a flush may be split.
+        self.marks.append((len(self.wr_buffer), self.rd_len))
+
+    def chunks(self):
+        # Greedily group the marked segments into (wr_end, rd_end) chunks
+        # that fit within tx_chunk/rx_chunk. A single oversized segment is
+        # sent on its own.
+        ret = []
+        wr_start = rd_start = 0
+        last = None
+        for wr_end, rd_end in self.marks + [(len(self.wr_buffer), self.rd_len)]:
+            if (last is not None and last != (wr_start, rd_start) and
+                    (wr_end - wr_start > self.tx_chunk or
+                     rd_end - rd_start > self.rx_chunk)):
+                ret.append(last)
+                wr_start, rd_start = last
+            last = (wr_end, rd_end)
+        if last is not None and last[0] > wr_start:
+            ret.append(last)
+        return ret
 
     def flush_all(self):
-        self.flush_output()
-        self.flush_input()
+        if self.recording is not None:
+            raise Exception("Cannot flush while recording a program")
+        if (len(self.wr_buffer) <= self.tx_chunk and
+                self.rd_len <= self.rx_chunk):
+            if self.rd_len:
+                self.cmd(ftdi.SEND_IMMEDIATE)
+            self.flush_output()
+            self.flush_input()
+            self.check_nacks()
+            return
+
+        # Keep one chunk in flight ahead of the one being read back.
+        wr_buffer = self.wr_buffer
+        chunks = self.chunks()
+        self.wr_buffer = bytearray()
+        self.marks = []
+        wr_start = rd_start = 0
+        pending = []
+        for wr_end, rd_end in chunks:
+            data = bytearray(buffer(wr_buffer, wr_start, wr_end - wr_start))
+            if rd_end > rd_start:
+                data.append(ftdi.SEND_IMMEDIATE)
+                if self.counters is not None:
+                    self.counters.cmds += 1
+                    self.counters.cmd_bytes += 1
+            self.write(data)
+            pending.append(rd_end - rd_start)
+            wr_start, rd_start = wr_end, rd_end
+            if len(pending) > 1:
+                self.flush_input(pending.pop(0))
+        for count in pending:
+            self.flush_input(count)
+        self.check_nacks()
+
+    def nack(self, tag):
+        if self.counters is not None:
+            self.counters.nacks += 1
+        self.i2c_error = True
+        if tag is None:
+            self.unhandled += 1
+        else:
+            self.failed.add(tag)
+
+    def check_nacks(self):
+        if self.unhandled:
+            self.unhandled = 0
+            raise Exception("I2C error")
+
+    def instrument(self, enable=True):
+        # Start counting into fresh counters, returned, or stop. The hot
+        # paths are only wrapped on this instance while enabled, so there is
+        # nothing to pay otherwise.
+        if self.counters is not None:
+            self.port = self.port.port
+            del self.cmd
+            del self.cmd2
+            self.counters = None
+        if not enable:
+            return None
+        c = self.counters = counters(self)
+        self.port = timed_port(self.port, c)
+        cmd = self.cmd
+        cmd2 = self.cmd2
+        # Commands recorded into a program are counted when it is replayed.
+        def counted_cmd(op, *args):
+            if self.recording is None:
+                c.cmds += 1
+                c.cmd_bytes += 1 + len(args)
+            cmd(op, *args)
+        def counted_cmd2(op, data):
+            if self.recording is None:
+                c.cmds += 1
+                c.cmd_bytes += 3
+            cmd2(op, data)
+        self.cmd = counted_cmd
+        self.cmd2 = counted_cmd2
+        return c
+
+    def state(self):
+        return (self.gpio, self.dir, self.high, self.low, self.hz, self.three_phase)
+
+    def checkpoint(self):
+        # The end of the queue and the tracked state, see rewind().
+        return (len(self.wr_buffer), self.rd_len, len(self.dest),
+                len(self.marks), self.state(), self.elapsed, self.ticks)
+
+    def rewind(self, point):
+        # Drop the commands queued since checkpoint() returned point. No
+        # flush may have happened in between.
+        wr_start, rd_start, dest_start, marks_start, state, elapsed, ticks = point
+        del self.wr_buffer[wr_start:]
+        del self.marks[marks_start:]
+        for i in range(dest_start, len(self.dest)):
+            self.dest.pop()
+        self.rd_len = rd_start
+        self.gpio, self.dir, self.high, self.low = state[:4]
+        self.elapsed = elapsed
+        self.ticks = ticks
+
+    def record(self):
+        # Start capturing queued commands into a program instead of
+        # sending them, see compile().
+        self.recording = self.checkpoint()
+
+    def compile(self):
+        # Stop recording and return the captured commands as a program.
+        # Response consumers other than the ACK checks are called once
+        # with their offset into the program's response, so the read
+        # buffers handed to i2c.xfer() end up holding offsets.
+        point = self.recording
+        wr_start, rd_start, dest_start, marks_start, state, elapsed, ticks = point
+        self.recording = None
+        data = bytes(self.wr_buffer[wr_start:])
+        entries = list(itertools.islice(self.dest, dest_start, None))
+        marks = [(w - wr_start, r - rd_start) for w, r in self.marks[marks_start:]]
+        rd_len = self.rd_len - rd_start
+        end_state = self.state()
+        duration = self.elapsed - elapsed
+        ticks = self.ticks - ticks
+        self.rewind(point)
+
+        nacks = []
+        offset = 0
+        for n, func in entries:
+            if n is not None:
+                raise Exception("Cannot record a program inside a program")
+            if isinstance(func, ack):
+                nacks.append((offset, func.tag))
+            else:
+                func(offset)
+            offset += 1
+        return program(data, rd_len, marks, nacks, state, end_state, duration, ticks)
+
+    def replay(self, prog, func):
+        # Queue a compiled program, func receives its response block.
+        if not prog.matches(self):
+            raise Exception("Program does not match GPIO state")
+        wr_start = len(self.wr_buffer)
+        rd_start = self.rd_len
+        self.wr_buffer += prog.data
+        self.marks.extend((wr_start + w, rd_start + r) for w, r in prog.marks)
+        self.gpio, self.dir, self.high, self.low = prog.end_state[:4]
+        self.elapsed += prog.duration
+        self.ticks += prog.ticks
+        if self.counters is not None:
+            self.counters.replays += 1
+            self.counters.transactions += len(prog.marks)
+            self.counters.cmd_bytes += len(prog.data)
+        def check(data):
+            for offset, tag in prog.nacks:
+                if data[offset] & 1:
+                    self.nack(tag)
+            func(data)
+        self.expect(check, prog.rd_len)
 
     def gpio_update(self, high):
+        # Returns False if the update was dropped as redundant.
         if self.hw_error:
             raise Exception(self.hw_error)
         if high:
+            if self.high == (self.gpio >> 8, self.dir >> 8):
+                return False
+            self.high = (self.gpio >> 8, self.dir >> 8)
             self.cmd(ftdi.SET_BITS_HIGH, self.gpio >> 8, self.dir >> 8)
         else:
+            if self.low == (self.gpio & 0xff, self.dir & 0xff):
+                return False
+            self.low = (self.gpio & 0xff, self.dir & 0xff)
             self.cmd(ftdi.SET_BITS_LOW, self.gpio & 0xff, self.dir & 0xff)
+        return True
 
     def gpio_output(self, gpio):
         self.dir |= 1 << gpio
@@ -108,14 +533,32 @@ class i2c_ftdi(object):
 
         if gpio > 7:
             self.cmd(ftdi.GET_BITS_HIGH)
-            self.dest.append(lambda b: assign(b, gpio - 8))
+            self.expect(lambda b: assign(b, gpio - 8))
         else:
             self.cmd(ftdi.GET_BITS_LOW)
-            self.dest.append(lambda b: assign(b, gpio))
+            self.expect(lambda b: assign(b, gpio))
         self.flush_all()
 
         return self.gpio_value_ret
 
+    def wait_pin(self, gpio, level, timeout=0.1):
+        # Hold off the commands that follow until gpio reads level. The MPSSE
+        # engine can wait in-stream on WAIT_GPIO, any other pin is polled
+        # from the host with GET_BITS, flushing everything queued so far.
+        # timeout counts from the first poll's answer, which only comes
+        # once everything queued before it has run.
+        if gpio == WAIT_GPIO:
+            self.cmd(ftdi.WAIT_ON_HIGH if level else ftdi.WAIT_ON_LOW)
+            return
+        end = None
+        while self.gpio_value(gpio) != level:
+            if self.hw_error:
+                raise Exception(self.hw_error)
+            if end is None:
+                end = time.time() + timeout
+            elif time.time() > end:
+                raise Exception("Timed out waiting for GPIO", gpio)
+
     def gpio_low(self, gpio):
         self.gpio &= ~(1 << gpio)
 
@@ -140,29 +583,47 @@ class i2c_ftdi(object):
         self.wr_buffer.extend([cmd, data & 0xff, data >> 8])
 
     def cmd(self, cmd, *args):
-        self.wr_buffer.extend([cmd] + list(args))
+        self.wr_buffer.append(cmd)
+        self.wr_buffer.extend(args)
 
     def set_rate(self, hz):
-        self.hz = hz
-        numerator = 30000000;
-        if hz >= 60000000:
-            self.cmd(ftdi.DIS_DIV_5)
-        else:
+        # Set SCL to at most hz. Three phase clocking stretches each bit to
+        # 1.5 TCK periods, so TCK is set that much faster. hz is left at
+        # the rate actually set, the divisor is an integer.
+        factor = 1.5 if self.three_phase else 1.0
+        tck = hz * factor
+        numerator = 30000000
+        divisor = int(math.ceil(numerator / tck)) - 1
+        if divisor > 0xffff:
             self.cmd(ftdi.EN_DIV_5)
             numerator /= 5
-        divisor = numerator / hz - 1
+            divisor = int(math.ceil(numerator / tck)) - 1
+        else:
+            self.cmd(ftdi.DIS_DIV_5)
+        divisor = max(0, min(0xffff, divisor))
         self.cmd2(ftdi.TCK_DIVISOR, divisor)
+        self.hz = numerator / (divisor + 1.0) / factor
+
+    def bit_time(self):
+        return 1.0 / self.hz
+
+    def clocked(self, bits):
+        self.elapsed += bits * self.bit_time()
 
     def delay(self, seconds):
-        m = self.hz / 8.0
-        if self.three_phase:
-            m /= 1.5
-        ticks = int(math.ceil(seconds * m))
+        ticks = int(math.ceil(seconds / (8 * self.bit_time())))
+        self.clocked(ticks * 8)
+        self.ticks += ticks
         while ticks:
             n = min(ticks, 0x10000)
             ticks -= n
             self.cmd2(ftdi.CLK_BYTES, n - 1)
 
+    def wait_until(self, t):
+        # Delay until t on the elapsed timeline, if it has not passed.
+        if t > self.elapsed:
+            self.delay(t - self.elapsed)
+
     def start(self):
         self.i2c_error = False
         self.append_data_clock((0, 1))
@@ -172,24 +633,35 @@ class i2c_ftdi(object):
 
     def stop(self):
         self.append_data_clock((0, 0), (0, 1), (1, 1))
+        self.mark()
 
-    def acknak(self, val):
-        self.cmd(ftdi.MPSSE_DO_WRITE | ftdi.MPSSE_WRITE_NEG | ftdi.MPSSE_BITMODE, 0, 0 if val else 0x80)
+    def recover(self):
+        # Clock out a target left driving SDA mid byte, then stop.
+        self.append_data_clock((None, 0))
+        self.cmd(ftdi.CLK_BITS, 7)
+        self.cmd(ftdi.CLK_BITS, 0)
+        self.clocked(9)
+        self.stop()
 
-    def apply_nack(self, b):
-        if b & 1:
-            self.i2c_error = True
-            raise Exception("I2C error")
+    def acknak(self, val):
+        # SDA is set up with SCL low and clocked without data, which keeps
+        # the low byte's tracked state valid.
+        self.append_data_clock((not val, 0))
+        self.cmd(ftdi.CLK_BITS, 0)
+        self.clocked(1)
 
     def outb(self, byte):
         self.append_data_clock((0, 0))
         self.cmd(ftdi.MPSSE_DO_WRITE | ftdi.MPSSE_WRITE_NEG | ftdi.MPSSE_BITMODE, 7, byte)
+        self.low = None
         self.append_data_clock((None, 0))
         self.cmd(ftdi.MPSSE_DO_READ | ftdi.MPSSE_BITMODE, 0)
-        self.dest.append(self.apply_nack)
+        self.clocked(9)
+        self.expect(ack(self, self.tag))
 
     def inb(self, func):
+        # After an ACK read SDA is already released, the update is dropped.
         self.append_data_clock((None, 0))
-        self.cmd2(ftdi.MPSSE_DO_READ, 0)
-        self.append_data_clock((0, 0))
-        self.dest.append(func)
+        self.cmd(ftdi.MPSSE_DO_READ | ftdi.MPSSE_BITMODE, 7)
+        self.clocked(8)
+        self.expect(func)
@@ -0,0 +1,160 @@
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SHUNT_LSB = 1 / 400000.0
+BUS_LSB = 1 / 800.0
+
+REG_CONFIG = 0
+REG_SHUNT = 1
+REG_BUS = 2
+REG_MASK = 6
+REG_MANUFACTURER_ID = 0xfe
+REG_DIE_ID = 0xff
+
+MANUFACTURER_ID = 0x5449
+DIE_ID = 0x2260
+
+MASK_CNVR = 0x0400
+
+AVERAGES = [1, 4, 16, 64, 128, 256, 512, 1024]
+CONVERSION_TIMES = [140e-6, 204e-6, 332e-6, 588e-6, 1100e-6, 2116e-6, 4156e-6, 8244e-6]
+
+MODE_TRIGGERED = 3
+MODE_SHUNT_CONTINUOUS = 5
+MODE_BUS_CONTINUOUS = 6
+MODE_CONTINUOUS = 7
+DEFAULT_CONFIG = 0x4127
+
+def config(avg=1, vbusct=1100e-6, vshct=1100e-6, mode=MODE_CONTINUOUS):
+    # Build a configuration register value. Averages and conversion times
+    # are rounded up to the next supported setting.
+    def index(table, val):
+        for i, v in enumerate(table):
+            if v >= val * 0.999:
+                return i
+        return len(table) - 1
+    return (0x4000 | index(AVERAGES, avg) << 9 | index(CONVERSION_TIMES, vbusct) << 6 |
+            index(CONVERSION_TIMES, vshct) << 3 | mode)
+
+def ready_times(config):
+    # When the shunt and bus results of a triggered conversion started by
+    # writing config are available. Without averaging the shunt result is
+    # ready before the bus conversion starts.
+    avg = AVERAGES[(config >> 9) & 7]
+    vbus = CONVERSION_TIMES[(config >> 6) & 7]
+    vsh = CONVERSION_TIMES[(config >> 3) & 7]
+    total = avg * (vsh + vbus)
+    return (vsh if avg == 1 else total), total
+
+scans = collections.namedtuple('scans', ['channels', 'shunt', 'bus', 'current', 'power'])
+trace = collections.namedtuple('trace', ['channel', 'period', 'raw', 'values'])
+
+def offsets(prog):
+    # Split a pmc scan program layout into index arrays for the high and
+    # low bytes of each channel's shunt and bus registers, in the order the
+    # channels were asked for rather than the order they are read in.
+    layout = dict((chan, shunt + bus) for chan, shunt, bus in prog.layout)
+    idx = numpy.array([layout[chan] for chan in prog.channels], dtype=numpy.intp)
+    return idx[:, 0], idx[:, 1], idx[:, 2], idx[:, 3]
+
+def raw(responses):
+    # Gather the register words of many (program, response) scans of one
+    # channel list into (samples x channels) arrays, shunt as int16 and bus
+    # as uint16. Scans may alternate between programs of differing layout.
+    if numpy is None:
+        raise Exception("numpy is required for batch decoding")
+    rows = collections.OrderedDict()
+    for i, (prog, data) in enumerate(responses):
+        rows.setdefault(prog, []).append(i)
+    shape = (len(responses), len(responses[0][0].channels))
+    shunt = numpy.empty(shape, dtype=numpy.uint16)
+    bus = numpy.empty(shape, dtype=numpy.uint16)
+    for prog, idx in rows.items():
+        data = numpy.frombuffer(bytearray().join(responses[i][1] for i in idx), dtype=numpy.uint8)
+        data = data.reshape(len(idx), prog.rd_len)
+        sh, sl, bh, bl = offsets(prog)
+        shunt[idx] = (data[:, sh].astype(numpy.uint16) << 8) | data[:, sl]
+        bus[idx] = (data[:, bh].astype(numpy.uint16) << 8) | data[:, bl]
+    return shunt.view(numpy.int16), bus
+
+def failed(responses):
+    # (samples x channels) boolean array of the reads that were NACKed.
+    channels = responses[0][0].channels
+    ret = numpy.zeros((len(responses), len(channels)), dtype=bool)
+    rows = collections.OrderedDict()
+    for i, (prog, data) in enumerate(responses):
+        rows.setdefault(prog, []).append(i)
+    for prog, idx in rows.items():
+        if not prog.nacks:
+            continue
+        data = numpy.frombuffer(bytearray().join(responses[i][1] for i in idx), dtype=numpy.uint8)
+        data = data.reshape(len(idx), prog.rd_len)
+        offsets = numpy.array([offset for offset, tag in prog.nacks], dtype=numpy.intp)
+        nacked = (data[:, offsets] & 1).astype(bool)
+        for col, chan in enumerate(channels):
+            mine = numpy.array([tag == chan for offset, tag in prog.nacks])
+            ret[idx, col] = nacked[:, mine].any(axis=1)
+    return ret
+
+def units(channels, shunt_raw, bus_raw, r, mask=None):
+    # Scale raw words to volts, amps and watts. r holds the shunt value of
+    # each channel, None where there is no shunt, giving NaN current/power.
+    # Reads set in mask, a boolean array as returned by failed(), are NaN.
+    r = numpy.array([numpy.nan if v is None else v for v in r], dtype=numpy.float64)
+    shunt = shunt_raw * SHUNT_LSB
+    bus = bus_raw * BUS_LSB
+    current = shunt / r
+    ret = scans(channels, shunt, bus, current, current * bus)
+    if mask is not None:
+        for values in ret[1:]:
+            values[mask] = numpy.nan
+    return ret
+
+def decode(responses, r):
+    # As units(), with NaN for the reads that were NACKed.
+    shunt_raw, bus_raw = raw(responses)
+    return units(responses[0][0].channels, shunt_raw, bus_raw, r, failed(responses))
+
+def decode_trace(channel, period, offsets, responses, n, bus, r, failed=None):
+    # Single channel capture, see pmc.capture(). offsets holds the response
+    # offsets of each read's high and low byte within one block. values are
+    # in volts, or amps for a shunt capture with a known shunt. failed
+    # holds the indices of the NACKed reads of each block, those values
+    # are NaN.
+    if numpy is None:
+        raise Exception("numpy is required for batch decoding")
+    data = numpy.frombuffer(bytearray().join(responses), dtype=numpy.uint8)
+    data = data.reshape(len(responses), -1)
+    idx = numpy.array(offsets, dtype=numpy.intp)
+    words = (data[:, idx[:, 0]].astype(numpy.uint16) << 8) | data[:, idx[:, 1]]
+    words = words.reshape(-1)[:n]
+    if bus:
+        values = words * BUS_LSB
+    else:
+        words = words.view(numpy.int16)
+        values = words * SHUNT_LSB
+        if r is not None:
+            values /= r
+    if failed:
+        mask = numpy.zeros((len(responses), len(offsets)), dtype=bool)
+        for i, block in enumerate(failed):
+            for j in block:
+                mask[i, j] = True
+        values[mask.reshape(-1)[:n]] = numpy.nan
+    return trace(channel, period, words, values)
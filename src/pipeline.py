@@ -0,0 +1,148 @@
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Acquisition in its own process. The acquisition process only runs the
+# bus and appends raw register words to a capture file ring, kept in
+# shared memory unless a path is given. Decoding, statistics and output
+# happen in the processes following the ring, any number of which may
+# attach, see capture.py -f. Nothing is locked: the writer publishes the
+# record count after the records and never waits for readers, a reader
+# that falls more than the ring behind loses the oldest scans and counts
+# them as overruns.
+
+import capture
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+def shm_path():
+    d = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, path = tempfile.mkstemp(prefix='pmc-', suffix='.cap', dir=d)
+    os.close(fd)
+    return path
+
+def acquire(factory, path, channels, count, batch, capacity, ready, stop, done, errors):
+    try:
+        device = factory()
+        channels = [chan for chan in channels if chan in device.sensors]
+        out = capture.writer(path, channels, [device.sensors[chan].r for chan in channels],
+                             capacity)
+        ready.set()
+        try:
+            n = 0
+            while not stop.is_set() and (count is None or n < count):
+                scans = batch if count is None else min(batch, count - n)
+                device.record(out, channels, scans, scans)
+                n += scans
+        finally:
+            out.close()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        errors.put(e)
+    done.set()
+
+class follower(object):
+    # Reads new scans from the ring of a capture file being written.
+    # margin is the most scans the writer appends at once, those past the
+    # published count may be half written already.
+    def __init__(self, path, margin, start=0):
+        self.reader = capture.reader(path)
+        self.margin = margin
+        self.cursor = start
+        self.overruns = 0
+
+    def read(self):
+        # Copies of the records written since the last call, oldest first.
+        count = self.reader.count()
+        keep = self.reader.capacity - self.margin
+        if count - self.cursor > keep:
+            self.overruns += count - keep - self.cursor
+            self.cursor = count - keep
+        start = self.cursor % self.reader.capacity
+        n = count - self.cursor
+        ring = self.reader.ring
+        if start + n <= self.reader.capacity:
+            records = ring[start:start + n].copy()
+        else:
+            records = capture.numpy.concatenate((ring[start:], ring[:start + n - len(ring)]))
+        # The writer may have lapped the copy, drop what it could have
+        # overwritten meanwhile.
+        lost = self.reader.count() - keep - self.cursor
+        if lost > 0:
+            self.overruns += lost
+            records = records[lost:]
+        self.cursor = count
+        return records
+
+class pipeline(object):
+    # Scan channels of the board opened by factory in a separate process,
+    # factory must be picklable. batch is the number of scans per USB
+    # transfer, capacity the ring size in scans.
+    def __init__(self, factory, channels, count=None, batch=64, capacity=65536,
+                 path=None, poll=0.01):
+        self.path = path or shm_path()
+        self.temporary = path is None
+        self.batch = batch
+        self.poll = poll
+        self.ready = multiprocessing.Event()
+        self.stop = multiprocessing.Event()
+        self.done = multiprocessing.Event()
+        self.errors = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=acquire,
+                args=(factory, self.path, channels, count, batch, capacity,
+                      self.ready, self.stop, self.done, self.errors))
+        self.process.daemon = True
+        self.process.start()
+        while not self.ready.wait(0.1):
+            if self.done.is_set():
+                self.close()
+                self.check()
+                raise Exception("Acquisition process exited")
+        self.follower = follower(self.path, batch)
+        self.channels = self.follower.reader.channels
+        self.r = self.follower.reader.r
+
+    def check(self):
+        # Exiting flushes the queue, join before looking at it.
+        self.process.join()
+        if not self.errors.empty():
+            raise self.errors.get()
+
+    def blocks(self, f=sys.stderr):
+        # Yields (times, ina226.scans) as scans arrive, until acquisition
+        # ends. Overruns are reported on f as they happen.
+        try:
+            while True:
+                done = self.done.is_set()
+                overruns = self.follower.overruns
+                records = self.follower.read()
+                if self.follower.overruns != overruns:
+                    f.write('# overrun, {} scans lost\n'.format(self.follower.overruns - overruns))
+                    f.flush()
+                if len(records):
+                    yield self.follower.reader.decode(records)
+                elif done:
+                    break
+                else:
+                    time.sleep(self.poll)
+            self.check()
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop.set()
+        self.process.join()
+        if self.temporary and os.path.exists(self.path):
+            os.unlink(self.path)
@@ -13,12 +13,27 @@
 # Lesser General Public License for more details.
 
 import ftdi
+import ftdi_sim
 import i2c_ftdi
 import i2c
+import ina226
+import pmcd
+import stats
 import time
 import collections
 import argparse
+import atexit
+import capture
+import decimate
+import functools
+import json
 import math
+import multiprocessing
+import os
+import pipeline
+import Queue
+import sys
+import threading
 import usb
 
 scl = 0
@@ -30,37 +45,81 @@ sws = [7, 6]
 addrs = [ 11, 10, 9, 8 ]
 gpios = [ 15, 14, 13, 12 ]
 
+# SCL rates, see --i2c-rate and calibrate. Calibrated rates are kept per
+# board, by USB serial, in RATES_FILE. The INA226 is only rated to 400kHz
+# in fast mode. Faster needs high-speed mode, entered with a master code
+# sent at fast mode rates after every START and left at every STOP, and
+# current source pull-ups the board does not have, so rates stop at
+# MAX_RATE.
+DEFAULT_RATE = 400000
+MAX_RATE = 400000
+CALIBRATION_RATES = [100000, 200000, 300000, 400000]
+RATES_FILE = os.path.expanduser('~/.pmc17_rates')
+
+# USB product string of a PMC-17, other FT2232H devices are left alone.
+PRODUCT = "PMC-17 v1.0"
+
 def bit(b):
     return 1 << b
 
 initial_output = (bit(addrs[0]) | bit(addrs[1]) | bit(addrs[2]) | bit(addrs[3]) |
                   bit(nvouten) | bit(sws[0]) | bit(sws[1]))
 
+# A sample of a NACKed sensor is failed, with NaN values.
+sample = collections.namedtuple('sample', ['shunt', 'bus', 'current', 'power', 'failed'])
+
 class reading(object):
-    def __init__(self, addr, r, mux_addr=None):
+    def __init__(self, addr, r, mux_addr=None, config=ina226.DEFAULT_CONFIG, settle=0.001):
         self.addr = addr
         self.r = r
         self.mux_addr = mux_addr
+        self.pending = collections.deque()
+        # Muxed sensors are triggered once the mux has settled, and read as
+        # soon as each result is ready.
+        if mux_addr is not None:
+            config = (config & ~7) | ina226.MODE_TRIGGERED
+        self.config = config
+        self.settle = settle
+        self.shunt_ready, self.bus_ready = ina226.ready_times(config)
 
-    def queue_read(self, p):
+    def queue_read(self, p, alert_pin=None, wait=None):
+        # Several reads may be queued before a flush, fin() consumes them
+        # in order. With alert_pin a muxed sensor is read once it signals
+        # conversion ready rather than after a fixed wait, most of the
+        # conversion time is still spent in-stream before looking. wait is
+        # called with each deadline on the i2c_ftdi elapsed timeline, the
+        # scan planner passes one that fills the wait with other reads.
+        if wait is None:
+            wait = p.hw.wait_until
         self.bus_buf = []
         self.shunt_buf = []
+        self.pending.append((self.shunt_buf, self.bus_buf))
         if self.mux_addr is not None:
-            p.addr(self.mux_addr)
-            p.hw.delay(0.001)
-            p.i2c.xfer((self.addr, 0, [0, 0x41, 0x23], None))
-            p.hw.delay(0.0011)
+            # The mux only needs to settle if it actually moved.
+            if p.addr(self.mux_addr):
+                wait(p.hw.elapsed + self.settle)
+            p.i2c.xfer((self.addr, 0, [ina226.REG_CONFIG, self.config >> 8, self.config & 0xff], None))
+            start = p.hw.elapsed
+            if alert_pin is not None:
+                wait(start + self.bus_ready * 0.9)
+                p.hw.wait_pin(alert_pin, 0, 0.1 + self.bus_ready)
+            else:
+                wait(start + self.shunt_ready)
         p.i2c.xfer((self.addr, 0, [1], None),
                    (self.addr, i2c.I2C_M_RD, self.shunt_buf, 2))
-        if self.mux_addr is not None:
-            p.hw.delay(0.0011)
+        if self.mux_addr is not None and alert_pin is None:
+            wait(start + self.bus_ready)
         p.i2c.xfer((self.addr, 0, [2], None),
                    (self.addr, i2c.I2C_M_RD, self.bus_buf, 2))
 
     def fin(self):
-        shunt_v = self.shunt_buf[1] | self.shunt_buf[0] << 8
+        self.shunt_buf, self.bus_buf = self.pending.popleft()
+        self.decode(self.shunt_buf[1] | self.shunt_buf[0] << 8,
+                    self.bus_buf[1] | self.bus_buf[0] << 8)
+
+    def decode(self, shunt_v, bus_v):
         self.shunt_v = shunt_v
-        bus_v = self.bus_buf[1] | self.bus_buf[0] << 8
+        self.failed = False
 
         if shunt_v >= 0x8000:
             shunt_v = shunt_v - 0x10000
@@ -70,10 +129,18 @@ class reading(object):
         self.current = None if self.r is None else self.shunt / self.r
         self.power = None if self.r is None else self.current * self.bus
 
+    def fail(self):
+        nan = float('nan')
+        self.shunt = self.bus = self.current = self.power = nan
+        self.failed = True
+
+    def sample(self):
+        return sample(self.shunt, self.bus, self.current, self.power, self.failed)
+
 
 class pmc(object):
-    def __init__(self, serial=None, index=None):
-        self.ftdic = ftdi.ftdi_context()
+    def __init__(self, serial=None, index=None, port=None, hz=DEFAULT_RATE):
+        self.ftdic = None
         self.ftdi = ftdi
         self.sensors = dict()
         self.hw_sw = dict()
@@ -86,21 +153,35 @@ class pmc(object):
         self.hw_sw["GPIO2"] = gpios[2]
         self.hw_sw["GPIO3"] = gpios[3]
         self.switches = dict()
+        self.programs = dict()
+        self.alert_armed = set()
+        # Follow-up batches to retry NACKed channels in, see read_scans().
+        self.retries = 0
+        # Configuration last written to each direct sensor.
+        self.configs = dict()
+        self.reverse = False
 
+        if hz > MAX_RATE:
+            raise Exception("SCL rate above fast mode", hz)
+        if port is None:
+            self.ftdic = ftdi.ftdi_context()
         try:
-            ret = ftdi.ftdi_init(self.ftdic)
-            if ret < 0:
-                raise Exception
-            ret = ftdi.ftdi_usb_open_desc_index(self.ftdic, 0x0403, 0x06010, "PMC-17 v1.0", serial, index if index else 0)
-            if ret < 0:
-                raise Exception("Could not open device", ftdi.ftdi_get_error_string(self.ftdic))
-            ret = ftdi.ftdi_set_interface(self.ftdic, ftdi.INTERFACE_A)
-            if ret < 0:
-                raise Exception
-            self.hw = i2c_ftdi.i2c_ftdi(self.ftdic, scl, sda_out, sda_in, 400000, initial_output)
+            if port is None:
+                ret = ftdi.ftdi_init(self.ftdic)
+                if ret < 0:
+                    raise Exception
+                ret = ftdi.ftdi_usb_open_desc_index(self.ftdic, 0x0403, 0x06010, PRODUCT, serial, index if index else 0)
+                if ret < 0:
+                    raise Exception("Could not open device", ftdi.ftdi_get_error_string(self.ftdic))
+                ret = ftdi.ftdi_set_interface(self.ftdic, ftdi.INTERFACE_A)
+                if ret < 0:
+                    raise Exception
+                port = i2c_ftdi.ftdi_port(self.ftdic)
+            self.hw = i2c_ftdi.i2c_ftdi(port, scl, sda_out, sda_in, hz, initial_output)
             self.i2c = i2c.i2c(self.hw)
         except Exception as e:
-            ftdi.ftdi_deinit(self.ftdic)
+            if self.ftdic is not None:
+                ftdi.ftdi_deinit(self.ftdic)
             raise
 
     def get_flag(self, sw, flag, default=False):
@@ -117,7 +198,8 @@ class pmc(object):
             sw = self.switches[sw.lower()]
         return self.hw_sw[sw.split(',')[0]]
 
-    def set_output(self, sw_list, val):
+    def queue_output(self, sw_list, val):
+        # Queue switching sw_list on or off, without flushing.
         update_low = False
         update_high = False
         for sw in sw_list:
@@ -132,7 +214,10 @@ class pmc(object):
         if update_low:
             self.hw.gpio_update(False)
         if update_high:
-            self.hw.gpio_update(False)
+            self.hw.gpio_update(True)
+
+    def set_output(self, sw_list, val):
+        self.queue_output(sw_list, val)
         self.hw.flush_all()
 
     def on(self, sw):
@@ -141,32 +226,19 @@ class pmc(object):
     def off(self, sw):
         self.set_output(sw, False)
 
+    def toggle_time(self, sw_list):
+        return max([float(self.get_flag(sw, 'toggle', 0.010)) for sw in sw_list] or [0])
+
     def toggle(self, sw_list):
-        update_low = False
-        update_high = False
-        max_delay = 0
-        for sw in sw_list:
-            bit = self.get_bit(sw)
-            val = self.get_flag(sw, 'active_low')
-            self.hw.gpio_output(bit)
-            self.hw.gpio_set(bit, val)
-            update_low |= bit < 8
-            update_high |= bit > 7
-            max_delay = max(max_delay, float(self.get_flag(sw, 'toggle', 0.010)))
-        if update_low:
-            self.hw.gpio_update(False)
-        if update_high:
-            self.hw.gpio_update(False)
-        self.hw.delay(max_delay)
-        for sw in sw_list:
-            self.hw.gpio_set(bit, not val)
+        # Switch off for the longest toggle time of sw_list, then back on.
+        self.queue_output(sw_list, False)
+        self.hw.delay(self.toggle_time(sw_list))
+        self.queue_output(sw_list, True)
         self.hw.flush_all()
-        if update_low:
-            self.hw.gpio_update(False)
-        if update_high:
-            self.hw.gpio_update(False)
 
-    def read_sw(self, sw_list):
+    def switch_states(self, sw_list):
+        # (name, on, pin level) of each of sw_list.
+        ret = []
         for sw in sw_list:
             bit = self.get_bit(sw)
             rh = self.get_flag(sw, 'reset_high')
@@ -181,7 +253,12 @@ class pmc(object):
             status = val
             if self.get_flag(sw, 'active_low'):
                 status = not status
-            print "{} {} ({})".format(sw.split(',')[0], "on" if status else "off", val)
+            ret.append((sw.split(',')[0], bool(status), val))
+        return ret
+
+    def read_sw(self, sw_list):
+        for name, status, val in self.switch_states(sw_list):
+            print "{} {} ({})".format(name, "on" if status else "off", val)
 
     def add_switch(self, sw_name, info):
         name, _, info = info.lower().partition(',')
@@ -191,24 +268,601 @@ class pmc(object):
             info = sw_name
         self.switches[name.lower()] = info
 
-    def add_sensor(self, name, addr, r=None, mux_addr=None):
-        self.sensors[name] = reading(addr, r, mux_addr)
+    def add_sensor(self, name, addr, r=None, mux_addr=None, avg=None,
+                   vbusct=None, vshct=None, settle=0.001):
+        # Muxed sensors get the configuration on every trigger, direct ones
+        # run continuously and are configured here. A direct sensor keeps
+        # whatever an earlier run left it with, so it is written once per
+        # process even if asked for the defaults. The write is tagged with
+        # the channel, an absent sensor fails its reads instead.
+        config = ina226.config(avg or 1, vbusct or 1100e-6, vshct or 1100e-6)
+        self.sensors[name] = reading(addr, r, mux_addr, config, settle)
+        if mux_addr is None and config != self.configs.get(addr):
+            tag, self.hw.tag = self.hw.tag, name
+            try:
+                self.i2c.smbus_write_word_data(addr, ina226.REG_CONFIG, config)
+            finally:
+                self.hw.tag = tag
+            self.configs[addr] = config
+        self.programs.clear()
 
     def addr(self, a):
+        # Returns False if the mux was already at a.
         for i in range(0, 4):
             self.hw.gpio_set(addrs[i], (a >> i) & 1)
-        self.hw.gpio_update(True)
+        return self.hw.gpio_update(True)
 
-    def read(self, channels):
+    def plan(self, channels, reverse=False):
+        # Order a scan to keep mux switches down. Muxed channels are
+        # grouped by mux address, ascending or descending, so that scans
+        # alternating direction start where the previous one left the mux.
+        # Direct sensors are returned separately to fill the waits.
+        muxed = [chan for chan in channels if self.sensors[chan].mux_addr is not None]
+        direct = [chan for chan in channels if self.sensors[chan].mux_addr is None]
+        muxed.sort(key=lambda chan: self.sensors[chan].mux_addr, reverse=reverse)
+        return muxed, direct
+
+    def compile_scan(self, channels, reverse=False):
+        # Record one scan of channels as an i2c_ftdi program. layout holds
+        # the response offsets of each channel's shunt and bus registers in
+        # the order they are read, channels the order they were asked for.
+        muxed, direct = self.plan(channels, reverse)
+        layout = []
+
+        def queue(chan, wait=None):
+            # Transactions are tagged with their channel so a NACK fails
+            # just that channel, restoring the tag of a muxed channel once
+            # a fill read is queued in its wait.
+            s = self.sensors[chan]
+            tag, self.hw.tag = self.hw.tag, chan
+            s.queue_read(self, wait=wait)
+            self.hw.tag = tag
+            layout.append((chan,) + s.pending.pop())
+
+        # Bus time of reading each direct sensor, measured by recording it.
+        cost = dict()
+        for chan in direct:
+            self.hw.record()
+            queue(chan)
+            cost[chan] = self.hw.compile().duration
+        del layout[:]
+
+        fill = collections.deque(direct)
+        def wait(t):
+            # Spend mux settling and conversion time on direct sensors
+            # rather than idle clocks, as long as they fit before t.
+            while fill and self.hw.elapsed + cost[fill[0]] <= t:
+                queue(fill.popleft())
+            self.hw.wait_until(t)
+
+        self.hw.record()
+        for chan in muxed:
+            queue(chan, wait)
+        while fill:
+            queue(fill.popleft())
+        prog = self.hw.compile()
+        prog.layout = layout
+        prog.channels = list(channels)
+        return prog
+
+    def scan_program(self, channels, reverse=False):
+        # Programs are cached per GPIO state as well as channel list and
+        # direction, as the mux position decides which writes are dropped.
+        key = (tuple(channels), reverse, self.hw.state())
+        prog = self.programs.get(key)
+        if prog is None:
+            if len(self.programs) > 64:
+                self.programs.clear()
+            prog = self.programs[key] = self.compile_scan(channels, reverse)
+        return prog
+
+    def queue_scans(self, channels, n, func):
+        # Alternate the scan direction so the mux is not switched between
+        # scans, looking up the program again for every replay. func is
+        # called with (program, response) for each scan.
+        for i in range(0, n):
+            prog = self.scan_program(channels, self.reverse)
+            self.i2c.replay(prog, lambda data, prog=prog: func(prog, data))
+            self.reverse = not self.reverse
+
+    def registers(self, channels, regs=(0, 1, 2, 3, 4, 5, 6, 7, 0xfe, 0xff)):
+        # Dump regs of the sensor of every channel in one batch. Returns
+        # {chan: {reg: value}}, None for a sensor that NACKed.
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        values = collections.OrderedDict()
+        self.hw.failed.clear()
+        tag = self.hw.tag
+        try:
+            with self.i2c.batch():
+                for chan in channels:
+                    s = self.sensors[chan]
+                    if s.mux_addr is not None:
+                        self.addr(s.mux_addr)
+                    self.hw.tag = chan
+                    values[chan] = [(reg, self.i2c.smbus_read_word_data(s.addr, reg)) for reg in regs]
+                self.hw.tag = tag
+        finally:
+            self.hw.tag = tag
+        ret = collections.OrderedDict()
         for chan in channels:
-            if chan not in self.hw_sw:
-                self.sensors[chan].queue_read(self)
+            ret[chan] = None
+            if chan not in self.hw.failed:
+                ret[chan] = collections.OrderedDict((reg, v.get()) for reg, v in values[chan])
+        return ret
+
+    def reset(self):
+        # Back to a known state after an error: whatever was queued or in
+        # flight is dropped, a target left mid transfer lets go of the bus
+        # and the mux address is written again on its next use.
+        self.hw.resync()
+        self.hw.tag = None
+        self.hw.failed.clear()
+        self.hw.recover()
+        self.hw.flush_all()
+
+    def set_rate(self, hz):
+        # Compiled programs are keyed by rate, they are recompiled.
+        if hz > MAX_RATE:
+            raise Exception("SCL rate above fast mode", hz)
+        self.hw.set_rate(hz)
+        self.hw.flush_all()
+
+    def verify(self, channels, n=8):
+        # Read the ID registers of the sensor of every channel n times and
+        # scan the channels n times. Returns a list of problems, NACKs and
+        # registers not reading back as expected, empty if there are none.
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        ids = ((ina226.REG_MANUFACTURER_ID, ina226.MANUFACTURER_ID),
+               (ina226.REG_DIE_ID, ina226.DIE_ID))
+        reads = []
+        self.hw.failed.clear()
+        tag = self.hw.tag
+        try:
+            for i in range(0, n):
+                for chan in channels:
+                    s = self.sensors[chan]
+                    if s.mux_addr is not None:
+                        self.addr(s.mux_addr)
+                    self.hw.tag = chan
+                    for reg, val in ids:
+                        buf = []
+                        self.i2c.xfer((s.addr, 0, [reg], None), (s.addr, i2c.I2C_M_RD, buf, 2))
+                        reads.append((chan, reg, val, buf))
+        finally:
+            self.hw.tag = tag
         self.i2c.flush()
+        failed = set(self.hw.failed)
+        problems = ["{} NACKed".format(chan) for chan in sorted(failed)]
+        for chan, reg, val, buf in reads:
+            got = buf[0] << 8 | buf[1]
+            if chan not in failed and got != val:
+                problems.append("{} register {:#04x} read {:#06x}, not {:#06x}".format(
+                                chan, reg, got, val))
+                failed.add(chan)
+
+        for record in self.read_scans(channels, n, 0):
+            for chan, s in record.items():
+                if s.failed and chan not in failed:
+                    problems.append("{} NACKed".format(chan))
+                    failed.add(chan)
+        return problems
+
+    def calibrate(self, channels, rates=CALIBRATION_RATES, n=8):
+        # Step up through rates on channels until one fails verify().
+        # Returns the fastest rate passing, or None, and (rate, problems)
+        # of every rate tried. The board is left at the rate returned, or
+        # at the one it had if none passed.
+        original = self.hw.hz
+        best = None
+        results = []
+        for hz in sorted(rates):
+            self.set_rate(hz)
+            try:
+                problems = self.verify(channels, n)
+            except Exception as e:
+                problems = [' '.join(str(arg) for arg in e.args) or repr(e)]
+            results.append((self.hw.hz, problems))
+            if problems:
+                break
+            best = hz
+        self.set_rate(best or original)
+        if results and results[-1][1]:
+            # Free the bus of a target left mid transfer at the failed rate.
+            self.hw.recover()
+            self.hw.flush_all()
+        return best, results
+
+    def decode_scan(self, prog, data):
+        samples = dict()
+        failed = prog.failed(data)
+        for chan, shunt, bus in prog.layout:
+            s = self.sensors[chan]
+            if chan in failed:
+                s.fail()
+            else:
+                s.decode(data[shunt[0]] << 8 | data[shunt[1]],
+                         data[bus[0]] << 8 | data[bus[1]])
+            samples[chan] = s.sample()
+        return collections.OrderedDict((chan, samples[chan]) for chan in prog.channels)
+
+    def read(self, channels):
+        return self.read_scans(channels, 1)[0]
+
+    def read_scans(self, channels, n, retries=None):
+        # Queue n complete scans back to back and flush them together, the
+        # flush is pipelined in FIFO sized chunks by i2c_ftdi. Each scan is
+        # a replay of the same compiled program. A NACK only fails the
+        # channel it belongs to, failed channels are read again in up to
+        # retries follow-up batches, self.retries by default.
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        responses = []
+        self.queue_scans(channels, n, lambda prog, data: responses.append((prog, data)))
+        self.i2c.flush()
+        records = [self.decode_scan(prog, data) for prog, data in responses]
+
+        for i in range(0, self.retries if retries is None else retries):
+            failed = [(record, [chan for chan, s in record.items() if s.failed])
+                      for record in records]
+            failed = [(record, chans) for record, chans in failed if chans]
+            if not failed:
+                break
+            responses = []
+            for record, chans in failed:
+                self.queue_scans(chans, 1, lambda prog, data: responses.append((prog, data)))
+            self.i2c.flush()
+            for (record, chans), (prog, data) in zip(failed, responses):
+                record.update(self.decode_scan(prog, data))
+        return records
+
+    def read_stats(self, channels, n=None, duration=None, batch=4096):
+        # Oversampled read of n scans, or of as many as take duration
+        # seconds of bus time, queued back to back and flushed in FIFO
+        # sized chunks. Returns a stats.accumulator of them.
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        if n is None:
+            n = max(1, int(math.ceil(duration / self.scan_program(channels).duration)))
+        acc = stats.accumulator()
+        done = 0
+        while done < n:
+            scans = min(batch, n - done)
+            t0 = time.time()
+            if ina226.numpy is None:
+                records = self.read_scans(channels, scans)
+            else:
+                values = self.read_arrays(channels, scans)
+            t1 = time.time()
+            step = (t1 - t0) / scans
+            t = [t0 + step * (i + 0.5) for i in range(0, scans)]
+            if ina226.numpy is None:
+                for t_i, record in zip(t, records):
+                    acc.add(t_i, record)
+            else:
+                acc.add_scans(t, values)
+            done += scans
+        return acc
+
+    def read_arrays(self, channels, n):
+        # As read_scans(), but decoded in one vectorized pass into
+        # (samples x channels) NumPy arrays, see ina226.decode().
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        responses = []
+        self.queue_scans(channels, n, lambda prog, data: responses.append((prog, data)))
+        self.i2c.flush()
+        return ina226.decode(responses, [self.sensors[chan].r for chan in channels])
+
+    def capture(self, chan, n, bus=False, ct=140e-6, block=256):
+        # Sample one channel as fast as it converts. The mux is parked on
+        # the channel and the sensor converts continuously, only the shunt
+        # (or only the bus) voltage, so with the pointer set once every
+        # sample is a bare two byte read. A block of reads paced to the
+        # conversion time is compiled once and replayed back to back.
+        # Returns an ina226.trace of n samples.
+        s = self.sensors[chan]
+        if bus:
+            reg = ina226.REG_BUS
+            config = ina226.config(1, ct, ct, ina226.MODE_BUS_CONTINUOUS)
+        else:
+            reg = ina226.REG_SHUNT
+            config = ina226.config(1, ct, ct, ina226.MODE_SHUNT_CONTINUOUS)
+        period = ina226.CONVERSION_TIMES[(config >> 3) & 7]
+        # The setup is tagged with the channel and every read of a block
+        # with its index, a NACK fails those samples rather than raising.
+        # Whatever happens, the sensor gets its configuration back.
+        self.hw.failed.clear()
+        tag = self.hw.tag
+        try:
+            if s.mux_addr is not None and self.addr(s.mux_addr):
+                self.hw.delay(s.settle)
+            self.hw.tag = chan
+            self.i2c.xfer((s.addr, 0, [ina226.REG_CONFIG, config >> 8, config & 0xff], None))
+            self.i2c.xfer((s.addr, 0, [reg], None))
+            self.hw.delay(period)
+
+            self.hw.record()
+            offsets = []
+            start = self.hw.elapsed
+            for i in range(0, block):
+                self.hw.wait_until(start + i * period)
+                buf = []
+                self.hw.tag = i
+                self.i2c.xfer((s.addr, i2c.I2C_M_RD, buf, 2))
+                offsets.append(buf)
+            self.hw.tag = tag
+            self.hw.wait_until(start + block * period)
+            prog = self.hw.compile()
+            # Reads slower than a conversion are not padded.
+            period = prog.duration / block
+
+            responses = []
+            for i in range(0, (n + block - 1) // block):
+                self.i2c.replay(prog, responses.append)
+            self.i2c.flush()
+            if chan in self.hw.failed:
+                failed = [range(0, block)] * len(responses)
+            else:
+                failed = [prog.failed(data) for data in responses]
+        except:
+            # An interrupted flush leaves responses in flight.
+            self.hw.resync()
+            raise
+        finally:
+            self.hw.tag = chan
+            config = self.configs.get(s.addr, ina226.DEFAULT_CONFIG)
+            try:
+                self.i2c.smbus_write_word_data(s.addr, ina226.REG_CONFIG, config)
+            finally:
+                self.hw.tag = tag
+        return ina226.decode_trace(chan, period, offsets, responses, n, bus, s.r, failed)
+
+    def triggered(self, channels, pre, post, sw_list, val=True, hold=None):
+        # Scan channels around switching sw_list to val, pre scans before
+        # the edge and post after it, all in one command stream so that the
+        # sample times relative to the edge are set by MPSSE clocks rather
+        # than the host. With hold the switches are put back hold seconds
+        # after the edge, between scans. Returns a list of (time relative
+        # to the edge, record), times being the middle of each scan on the
+        # i2c_ftdi elapsed timeline.
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        times = []
+        responses = []
+        def queue():
+            start = self.hw.elapsed
+            self.queue_scans(channels, 1, lambda prog, data: responses.append((prog, data)))
+            times.append((start + self.hw.elapsed) / 2)
+
+        for i in range(0, pre):
+            queue()
+        edge = self.hw.elapsed
+        self.queue_output(sw_list, val)
+        for i in range(0, post):
+            if hold is not None and self.hw.elapsed >= edge + hold:
+                self.queue_output(sw_list, not val)
+                hold = None
+            queue()
+        if hold is not None:
+            self.hw.wait_until(edge + hold)
+            self.queue_output(sw_list, not val)
+        self.i2c.flush()
+        return [(t - edge, self.decode_scan(prog, data))
+                for t, (prog, data) in zip(times, responses)]
+
+    def read_alert(self, channels):
+        # Read channels with each muxed sensor picked up as soon as its
+        # ALERT output reports conversion ready. ALERT is not on the pin the
+        # MPSSE engine can wait on, so this costs USB round trips per
+        # muxed channel in exchange for tighter sample timing.
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        self.hw.gpio_input(alert)
+        self.hw.gpio_update(False)
+        with self.i2c.batch():
+            for chan in channels:
+                s = self.sensors[chan]
+                if s.mux_addr is not None and s.addr not in self.alert_armed:
+                    self.i2c.smbus_write_word_data(s.addr, ina226.REG_MASK, ina226.MASK_CNVR)
+                    self.alert_armed.add(s.addr)
+        self.hw.failed.clear()
+        tag = self.hw.tag
+        try:
+            for chan in channels:
+                self.hw.tag = chan
+                self.sensors[chan].queue_read(self, alert)
+            self.hw.tag = tag
+            self.i2c.flush()
+        except:
+            # A wait that timed out leaves the reads of this scan pending.
+            for chan in channels:
+                self.sensors[chan].pending.clear()
+            raise
+        finally:
+            self.hw.tag = tag
+        record = collections.OrderedDict()
         for chan in channels:
-            if chan not in self.hw_sw:
-                self.sensors[chan].fin()
+            s = self.sensors[chan]
+            s.fin()
+            if chan in self.hw.failed:
+                s.fail()
+            record[chan] = s.sample()
+        return record
+
+    def stream(self, channels, rate=None, count=None, batch=1, use_alert=False, stats=None):
+        # Keep the device open and scan back to back, or paced at rate Hz.
+        # Each record is stamped with the host time at the middle of its
+        # scan, interpolated across the batch when batch > 1. Records are
+        # added to stats, a stats.accumulator, if given.
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        period = 1.0 / rate if rate else 0
+        next_t = time.time()
+        n = 0
+        while count is None or n < count:
+            scans = batch if count is None else min(batch, count - n)
+            if use_alert:
+                scans = 1
+            if period:
+                now = time.time()
+                if next_t > now:
+                    time.sleep(next_t - now)
+                else:
+                    next_t = now
+                next_t += period * scans
+            t0 = time.time()
+            if use_alert:
+                records = [self.read_alert(channels)]
+            else:
+                records = self.read_scans(channels, scans)
+            t1 = time.time()
+            step = (t1 - t0) / scans
+            for i, record in enumerate(records):
+                t = t0 + step * (i + 0.5)
+                if stats is not None:
+                    stats.add(t, record)
+                yield t, record
+            n += scans
+
+    def record(self, out, channels, count=None, batch=64, stats=None, pyramid=None):
+        # As stream(), but raw register words go to out, a capture.writer,
+        # undecoded along with which reads were NACKed. channels must be
+        # the writer's channel list. Scans are also added to pyramid, a
+        # decimate.pyramid, if given.
+        channels = [chan for chan in channels if chan not in self.hw_sw]
+        n = 0
+        while count is None or n < count:
+            scans = batch if count is None else min(batch, count - n)
+            responses = []
+            t0 = time.time()
+            self.queue_scans(channels, scans, lambda prog, data: responses.append((prog, data)))
+            self.i2c.flush()
+            t1 = time.time()
+            step = (t1 - t0) / scans
+            shunt, bus = ina226.raw(responses)
+            failed = ina226.failed(responses)
+            t = [t0 + step * (i + 0.5) for i in range(0, scans)]
+            out.append(t, shunt, bus, failed)
+            if stats is not None or pyramid is not None:
+                values = ina226.units(channels, shunt, bus,
+                                      [self.sensors[chan].r for chan in channels], failed)
+                if stats is not None:
+                    stats.add_scans(t, values)
+                if pyramid is not None:
+                    pyramid.add_scans(t, values)
+            n += scans
+
+def group_worker(factory, queue, go, stop, channels, rate, count, batch):
+    try:
+        device = factory()
+        queue.put('ready')
+        go.wait()
+        for item in device.stream(channels, rate, count, batch):
+            if stop.is_set():
+                break
+            queue.put(item)
+    except Exception as e:
+        queue.put(e)
+    queue.put(None)
+
+def missing_samples(values):
+    # Failed stand-ins for the samples of values.
+    nan = float('nan')
+    return collections.OrderedDict(
+        (chan, sample(nan, nan, None if s.current is None else nan,
+                      None if s.power is None else nan, True))
+        for chan, s in values.items())
+
+class group(object):
+    # Several boards sampled together. Each board runs its own acquisition
+    # loop in a thread, or a process if processes is set, and the streams
+    # are merged in time with channels qualified by board name. Records
+    # are stamped by the first board, every other board contributes its
+    # sample nearest to that time, failed if none is within one period.
+    # factories are called in the worker to open and configure each board,
+    # they must be picklable for processes.
+    def __init__(self, names, factories, processes=False):
+        self.names = names
+        self.factories = factories
+        self.processes = processes
+
+    def stream(self, channels, rate=None, count=None, batch=1, stats=None):
+        if self.processes:
+            worker = multiprocessing.Process
+            make_queue = multiprocessing.Queue
+            go = multiprocessing.Event()
+            stop = multiprocessing.Event()
+        else:
+            worker = threading.Thread
+            make_queue = Queue.Queue
+            go = threading.Event()
+            stop = threading.Event()
+
+        queues = []
+        workers = []
+        for factory in self.factories:
+            queue = make_queue(1024)
+            w = worker(target=group_worker,
+                       args=(factory, queue, go, stop, channels, rate, count, batch))
+            w.daemon = True
+            w.start()
+            queues.append(queue)
+            workers.append(w)
+
+        try:
+            # Start pacing on every board at once, after all have opened.
+            for queue in queues:
+                item = queue.get()
+                if isinstance(item, Exception):
+                    raise item
+            go.set()
 
-def parse_file(f, depth, points, mappings):
+            def get(queue):
+                item = queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                return item
+
+            tolerance = 1.0 / rate if rate else None
+            # Per board the samples either side of the last record's time.
+            held = [[] for queue in queues]
+            ended = [False for queue in queues]
+            while True:
+                item = get(queues[0])
+                if item is None:
+                    break
+                t = item[0]
+                items = [item]
+                for i in range(1, len(queues)):
+                    h = held[i]
+                    while not ended[i] and (not h or h[-1][0] < t):
+                        item = get(queues[i])
+                        if item is None:
+                            ended[i] = True
+                        else:
+                            h.append(item)
+                            del h[:-2]
+                    if not h:
+                        break
+                    item = min(h, key=lambda item: abs(item[0] - t))
+                    if tolerance is not None and abs(item[0] - t) > tolerance:
+                        item = (t, missing_samples(item[1]))
+                    items.append(item)
+                if len(items) < len(queues):
+                    break
+                record = collections.OrderedDict()
+                for name, item in zip(self.names, items):
+                    for chan, value in item[1].items():
+                        record[name + '.' + chan] = value
+                if stats is not None:
+                    stats.add(t, record)
+                yield t, record
+        finally:
+            stop.set()
+            go.set()
+            for queue, w in zip(queues, workers):
+                while w.is_alive():
+                    try:
+                        queue.get(timeout=0.1)
+                    except Queue.Empty:
+                        pass
+                w.join()
+
+def parse_file(f, depth, points, mappings, settings=None):
     if depth > 100:
         raise Exception("includes nested too deep, circular include?")
     for line in f:
@@ -217,7 +871,11 @@ def parse_file(f, depth, points, mappings):
             continue
         key, val = line.split(None, 1)
         if key.lower() == "include":
-            parse_file(open(val), depth + 1, points, mappings)
+            parse_file(open(val), depth + 1, points, mappings, settings)
+        elif key.lower() == "rate":
+            # SCL rate of the board in Hz.
+            if settings is not None:
+                settings['rate'] = int(float(val))
         else:
             try:
                 r = float(val)
@@ -225,8 +883,124 @@ def parse_file(f, depth, points, mappings):
             except:
                 mappings[key] = val
 
+def load_mappings(f=None, settings=None):
+    # settings, if given, gets the board settings of the file, its rate.
+    points = dict()
+    mappings = collections.OrderedDict()
+    if f is not None:
+        parse_file(f, 0, points, mappings, settings)
+    else:
+        for i in range(0, 16):
+            mappings["CH" + str(i)] = None
+
+    points["pmc.DC_IN"] = 0.050
+    mappings["CH16"] = "pmc.DC_IN"
+    return points, mappings
+
+def list_boards():
+    # (bus, device, serial) of every attached board, in --index order. As
+    # when opening one, only devices with the PMC-17 product string count.
+    ret = []
+    for bus in usb.busses():
+        for dev in bus.devices:
+            if dev.idVendor != 0x0403 or dev.idProduct != 0x6010:
+                continue
+            handle = dev.open()
+            if handle.getString(dev.iProduct, 1024) != PRODUCT:
+                continue
+            ret.append((bus.dirname, dev.devnum, handle.getString(dev.iSerialNumber, 1024)))
+    return ret
+
+def board_name(serial=None, index=None, sim=False):
+    # Name a board's calibrated rate is kept under, its USB serial. A board
+    # opened by index has its serial read from the device.
+    if sim:
+        return 'sim'
+    if serial is not None:
+        return serial
+    boards = list_boards()
+    if (index or 0) >= len(boards):
+        raise Exception("No board at index", index or 0)
+    return boards[index or 0][2]
+
+def load_rates(path=RATES_FILE):
+    try:
+        with open(path, 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return dict()
+
+def save_rate(name, hz, path=RATES_FILE):
+    rates = load_rates(path)
+    rates[name] = hz
+    with open(path, 'wb') as f:
+        json.dump(rates, f, indent=2, sort_keys=True)
+
+def bus_rate(serial=None, index=None, sim=False, settings=None, hz=None):
+    # The SCL rate to open a board at: hz if given, else the rate of the
+    # mapping file, else the calibrated one, else DEFAULT_RATE. The board
+    # is only looked up on USB for a calibrated rate. Rates calibrated
+    # before MAX_RATE was enforced are capped to it.
+    hz = hz or (settings or dict()).get('rate')
+    if hz:
+        return hz
+    rates = load_rates()
+    if not rates:
+        return DEFAULT_RATE
+    return min(rates.get(board_name(serial, index, sim)) or DEFAULT_RATE, MAX_RATE)
+
+def open_board(serial=None, index=None, points=None, mappings=None, sim=False, hz=None):
+    # Open a board, or a simulated one, and configure it from a mapping.
+    # hz is the SCL rate, DEFAULT_RATE by default.
+    port = None
+    board = None
+    if sim:
+        board = ftdi_sim.pmc17(addrs, alert)
+        port = ftdi_sim.port(board, scl, sda_out, sda_in)
+    device = pmc(serial, index, port, hz or DEFAULT_RATE)
+    if mappings is not None:
+        add_mappings(device, points, mappings, board)
+    return device
+
+def add_mappings(device, points, mappings, board=None):
+    # Register the sensors and switches of a mapping file with device,
+    # fitting a simulated sensor for each direct address if board is set.
+    # Sensor configuration writes go out together.
+    with device.i2c.batch():
+        for name, point in mappings.items():
+            if name in device.hw_sw:
+                device.add_switch(name, point)
+                continue
+            kwargs = dict()
+            if point is not None:
+                point, _, flags = point.partition(',')
+                for flag in flags.split(','):
+                    f, _, v = flag.partition('=')
+                    f = f.strip().lower()
+                    if f == 'avg':
+                        kwargs[f] = int(v)
+                    elif f in ('vbusct', 'vshct', 'settle'):
+                        kwargs[f] = float(v)
+                    elif f:
+                        raise Exception("Unknown flag for " + name, f)
+            r = None if point is None else points[point]
+            if name == "CH16":
+                addr = 0x4e
+                mux_addr = None
+            elif name[:2] == "CH":
+                addr = 0x4f
+                mux_addr = int(name[2:])
+            else:
+                addr = int(name, 0)
+                mux_addr = None
+                if board is not None:
+                    board.populate(addr)
+            device.add_sensor(name, addr, r, mux_addr, **kwargs)
+
+    device.add_switch("DC", "pmc.POWER,active_low,toggle=0.250")
+
 def print_si(val, sig=5):
-    digits = math.floor(math.log10(abs(val))) if val else 0
+    digits = math.floor(math.log10(abs(val))) if val and not math.isnan(val) else 0
     exp = int(digits // 3)
     digits = int(digits) % 3 + 1
     si = ''
@@ -235,60 +1009,148 @@ def print_si(val, sig=5):
         val /= math.pow(10, exp * 3)
     return '{: {}.{}f}{}'.format(val, digits, sig - digits, si)
 
+def scan_records(blocks, r, stats=None):
+    # (t, record) items of (times, ina226.scans) blocks as yielded by
+    # pipeline.blocks(), r holds each channel's shunt value. Failed reads
+    # are NaN in the blocks.
+    for t, scans in blocks:
+        if stats is not None:
+            stats.add_scans(t, scans)
+        for i in range(0, len(t)):
+            record = collections.OrderedDict()
+            for j, chan in enumerate(scans.channels):
+                bus = float(scans.bus[i, j])
+                if r[j] is None:
+                    record[chan] = sample(float(scans.shunt[i, j]), bus,
+                                          None, None, math.isnan(bus))
+                else:
+                    record[chan] = sample(float(scans.shunt[i, j]), bus,
+                                          float(scans.current[i, j]), float(scans.power[i, j]),
+                                          math.isnan(bus))
+            yield float(t[i]), record
+
+def print_stream(records):
+    header = False
+    try:
+        for t, values in records:
+            if not header:
+                names = ['time']
+                for name, s in values.items():
+                    if s.current is None:
+                        names += [name + '.V', name + '.Vshunt']
+                    else:
+                        names += [name + '.V', name + '.A', name + '.W']
+                print '# ' + ' '.join(names)
+                header = True
+            line = ['{:.6f}'.format(t)]
+            for name, s in values.items():
+                if s.current is None:
+                    line += ['{:g}'.format(s.bus), '{:g}'.format(s.shunt)]
+                else:
+                    line += ['{:g}'.format(s.bus), '{:g}'.format(s.current), '{:g}'.format(s.power)]
+            print ' '.join(line)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(conflict_handler='resolve')
     parser.add_argument('-m', '--mapping', type=argparse.FileType('rb'), required=False)
-    parser.add_argument('-s', '--serial', type=str, required=False)
+    parser.add_argument('-s', '--serial', type=str, action='append', required=False)
+    parser.add_argument('-p', '--processes', action="store_true")
     parser.add_argument('-i', '--index', type=int, required=False)
     parser.add_argument('-l', '--list', action="store_true")
+    parser.add_argument('--sim', action="store_true")
+    parser.add_argument('-r', '--rate', type=float, required=False)
+    parser.add_argument('-n', '--count', type=int, required=False)
+    parser.add_argument('-b', '--batch', type=int, default=1)
+    parser.add_argument('-a', '--alert', action="store_true")
+    parser.add_argument('--bus', action="store_true")
+    parser.add_argument('-o', '--output', type=str, required=False)
+    parser.add_argument('--capacity', type=int, default=1000000)
+    parser.add_argument('--summary', type=float, required=False)
+    parser.add_argument('--pre', type=int, default=10)
+    parser.add_argument('--profile', type=float, required=False)
+    parser.add_argument('--retries', type=int, default=0)
+    parser.add_argument('-P', '--pipeline', action="store_true")
+    parser.add_argument('--i2c-rate', type=int, required=False)
+    parser.add_argument('--samples', type=int, required=False)
+    parser.add_argument('--duration', type=float, required=False)
+    parser.add_argument('-d', '--daemon', type=str, nargs='?', const=pmcd.SOCKET, required=False)
     parser.add_argument("command", nargs="*")
 
     args = parser.parse_args()
 
     if args.list:
-        index = 0
-        for bus in usb.busses():
-            for dev in bus.devices:
-                if dev.idVendor != 0x0403 or dev.idProduct != 0x6010:
-                    continue
-                handle = dev.open()
-                print "{}/{}: index={}, serial={}".format(bus.dirname, dev.devnum, index, handle.getString(dev.iSerialNumber, 1024))
-                index += 1
+        for index, (bus, dev, serial) in enumerate(list_boards()):
+            print "{}/{}: index={}, serial={}".format(bus, dev, index, serial)
         exit()
 
-    points = dict()
-    mappings = collections.OrderedDict()
-    if args.mapping is not None:
-        parse_file(args.mapping, 0, points, mappings)
-    else:
-        for i in range(0, 16):
-            mappings["CH" + str(i)] = None
+    settings = dict()
+    points, mappings = load_mappings(args.mapping, settings)
+    def rate(serial):
+        return bus_rate(serial, args.index, args.sim, settings, args.i2c_rate)
 
-    points["pmc.DC_IN"] = 0.050
-    mappings["CH16"] = "pmc.DC_IN"
+    acc = None
+    if args.summary is not None:
+        acc = stats.accumulator()
+    def summarize(records):
+        # Print running statistics every --summary seconds to stderr.
+        if acc is None:
+            return records
+        return stats.periodic(records, acc, args.summary)
 
-    device = pmc(args.serial, args.index)
+    serials = args.serial or [None]
+    if len(serials) > 1:
+        if not args.command or args.command[0] != 'stream':
+            parser.error("multiple boards are only supported by stream")
+        factories = [functools.partial(open_board, serial, None, points, mappings, args.sim,
+                                       rate(serial))
+                     for serial in serials]
+        boards = group(serials, factories, args.processes)
+        channels = args.command[1:] or mappings.keys()
+        print_stream(summarize(boards.stream(channels, args.rate, args.count, args.batch, acc)))
+        exit()
+
+    if args.pipeline:
+        # Acquisition in a child process writing to a shared memory ring,
+        # or to --output, decoding and printing here.
+        if not args.command or args.command[0] != 'stream' or args.daemon or args.alert:
+            parser.error("--pipeline is only supported by stream, without --daemon or --alert")
+        factory = functools.partial(open_board, serials[0], args.index, points, mappings, args.sim,
+                                    rate(serials[0]))
+        p = pipeline.pipeline(factory, args.command[1:] or mappings.keys(), args.count,
+                              args.batch, args.capacity, args.output)
+        blocks = p.blocks()
+        if args.output:
+            blocks = decimate.feed(blocks, decimate.pyramid(decimate.pyramid_path(args.output),
+                                                            p.channels, p.r))
+        print_stream(summarize(scan_records(blocks, p.r, acc)))
+        exit()
+
+    if args.daemon:
+        # A thin client of pmcd, which has the board open already.
+        device = pmcd.client(args.daemon, serials[0])
+        if args.command and args.command[0] not in ('on', 'off', 'toggle', 'read', 'stream'):
+            parser.error(args.command[0] + " is not supported through the daemon")
+        if args.alert or args.output:
+            parser.error("--alert and --output are not supported through the daemon")
+    else:
+        device = open_board(serials[0], args.index, points, mappings, args.sim, rate(serials[0]))
+        device.retries = args.retries
+        if args.profile is not None:
+            # JSON counter snapshots on stderr, see i2c_ftdi.counters.
+            counters = device.i2c.instrument()
+            counters.report(args.profile)
+            atexit.register(counters.write)
     point_len = len("Total Power")
     name_len = 0
     for name, point in mappings.items():
-        if name in device.hw_sw:
-            device.add_switch(name, point)
-            continue
-        name_len = max(name_len, len(name))
-        r = None if point is None else points[point]
-        point_len = max(point_len, 0 if point is None else len(point))
-        if name == "CH16":
-            addr = 0x4e
-            mux_addr = None
-        elif name[:2] == "CH":
-            addr = 0x4f
-            mux_addr = int(name[2:])
-        else:
-            addr = int(name, 0)
-            mux_addr = None
-        device.add_sensor(name, addr, r, mux_addr)
-
-    device.add_switch("DC", "pmc.POWER,active_low,toggle=0.250")
+        if point is not None:
+            point = mappings[name] = point.partition(',')[0]
+        if name in device.sensors:
+            name_len = max(name_len, len(name))
+            point_len = max(point_len, 0 if point is None else len(point))
 
     if args.command:
         if args.command[0] == 'toggle':
@@ -299,13 +1161,134 @@ if __name__ == "__main__":
             device.off(args.command[1:])
         elif args.command[0] == 'read':
             device.read_sw(args.command[1:])
+        elif args.command[0] == 'stream':
+            channels = args.command[1:] or mappings.keys()
+            channels = [chan for chan in channels if chan in device.sensors]
+            if args.output:
+                r = [device.sensors[chan].r for chan in channels]
+                out = capture.writer(args.output, channels, r, args.capacity)
+                pyr = decimate.pyramid(decimate.pyramid_path(args.output), channels, r)
+                try:
+                    device.record(out, channels, args.count, args.batch, acc, pyr)
+                except KeyboardInterrupt:
+                    pass
+                out.close()
+                pyr.close()
+                if acc is not None:
+                    acc.report()
+                exit()
+            print_stream(summarize(device.stream(channels, args.rate, args.count, args.batch,
+                                                 args.alert, acc)))
+        elif args.command[0] == 'trigger':
+            # trigger on|off|toggle SW... scans every mapped channel around
+            # the switch edge, times are relative to it.
+            action = args.command[1]
+            sw_list = args.command[2:]
+            hold = None
+            if action == 'toggle':
+                hold = device.toggle_time(sw_list)
+            elif action not in ('on', 'off'):
+                parser.error("trigger needs on, off or toggle")
+            channels = [chan for chan in mappings.keys() if chan in device.sensors]
+            print_stream(device.triggered(channels, args.pre, args.count or 100,
+                                          sw_list, action == 'on', hold))
+        elif args.command[0] == 'regs':
+            # regs [CHANNEL...] dumps the registers of each sensor.
+            channels = args.command[1:] or [chan for chan in mappings.keys()
+                                           if chan in device.sensors]
+            for chan, regs in device.registers(channels).items():
+                if regs is None:
+                    print "{} failed".format(chan)
+                else:
+                    print "{} {}".format(chan, ' '.join('{:02x}={:04x}'.format(reg, v)
+                                                        for reg, v in regs.items()))
+        elif args.command[0] == 'calibrate':
+            # calibrate [HZ...] finds the fastest SCL rate every mapped
+            # sensor works at and keeps it for the board.
+            rates = [int(float(v)) for v in args.command[1:]] or CALIBRATION_RATES
+            channels = [chan for chan in mappings.keys() if chan in device.sensors]
+            best, results = device.calibrate(channels, rates, args.count or 8)
+            for hz, problems in results:
+                print "{}Hz {}".format(print_si(hz), ', '.join(problems[:3]) or "ok")
+            if best is None:
+                print "No rate passed"
+                exit(1)
+            save_rate(board_name(serials[0], args.index, args.sim), best)
+            print "{}Hz saved to {}".format(print_si(best), RATES_FILE)
+        elif args.command[0] == 'capture':
+            chan = args.command[1]
+            trace = device.capture(chan, args.count or 1000, args.bus)
+            if args.bus:
+                unit = '.V'
+            elif device.sensors[chan].r is None:
+                unit = '.Vshunt'
+            else:
+                unit = '.A'
+            print '# time ' + chan + unit
+            for i, v in enumerate(trace.values):
+                print '{:.6f} {:g}'.format(i * trace.period, v)
+    elif args.samples or args.duration:
+        # Statistics of many scans instead of a single one.
+        if args.alert or args.daemon:
+            parser.error("--samples and --duration are not supported with --alert or --daemon")
+        channels = [chan for chan in mappings.keys() if chan in device.sensors]
+        summary = device.read_stats(channels, args.samples, args.duration).summary()
+        # Without NumPy channels that always failed are missing from the
+        # summary, which is empty if all did.
+        n = max([s['bus']['n'] for s in summary.values() if 'bus' in s] or [0])
+        duration = max([s['duration'] for s in summary.values()] or [0.0])
+        print "{} scans in {}s".format(n, print_si(duration))
+        for name, point in mappings.items():
+            if name not in summary:
+                if name in device.sensors:
+                    print "({name:>{name_len}}) {point:<{point_len}} failed".format(
+                        name=name, name_len=name_len, point=point, point_len=point_len)
+                continue
+            s = summary[name]
+            if not s['bus']['n']:
+                print "({name:>{name_len}}) {point:<{point_len}} failed".format(
+                    name=name, name_len=name_len, point=point, point_len=point_len)
+                continue
+            for stat in ('mean', 'std', 'min', 'max'):
+                if stat == 'mean':
+                    prefix = "({name:>{name_len}}) {point:<{point_len}}".format(
+                        name=name, name_len=name_len, point=point, point_len=point_len)
+                else:
+                    prefix = " " * (name_len + point_len + 3)
+                if 'power' in s:
+                    line = "{prefix} {stat:<4} {bus}V * {current}A = {power}W".format(
+                        prefix=prefix, stat=stat, bus=print_si(s['bus'][stat]),
+                        current=print_si(s['current'][stat]), power=print_si(s['power'][stat]))
+                else:
+                    line = "{prefix} {stat:<4} {bus}V   {shunt}V".format(
+                        prefix=prefix, stat=stat, bus=print_si(s['bus'][stat]),
+                        shunt=print_si(s['shunt'][stat]))
+                if stat == 'mean' and s['bus']['n'] < n:
+                    line += " ({} failed)".format(n - s['bus']['n'])
+                print line
+
+        for name, point in (("Total", "Total power"), ("Remainder", "Remainder")):
+            if name not in summary:
+                continue
+            p = summary[name]['power']
+            print " {empty:>{name_len}}  {point:<{point_len}} {stats}".format(
+                empty="", name_len=name_len, point=point, point_len=point_len,
+                stats="  ".join("{} {}W".format(stat, print_si(p[stat]))
+                                for stat in ('mean', 'std', 'min', 'max')))
     else:
-        device.read(mappings.keys())
+        if args.alert:
+            record = device.read_alert(mappings.keys())
+        else:
+            record = device.read(mappings.keys())
         total = 0
         for name, point in mappings.items():
-            if name not in device.sensors:
+            if name not in record:
+                continue
+            s = record[name]
+            if s.failed:
+                print "({name:>{name_len}}) {point:<{point_len}} failed".format(
+                    name=name, name_len=name_len, point=point, point_len=point_len)
                 continue
-            s = device.sensors[name]
             if point is not None:
                 if name != "CH16":
                     total += s.power
@@ -317,7 +1300,7 @@ if __name__ == "__main__":
                     name=name, name_len=name_len, point=point, point_len=point_len,
                     bus=print_si(s.bus), shunt=print_si(s.shunt))
 
-        remainder = device.sensors["CH16"].power - total
+        remainder = record["CH16"].power - total
 
         print " {empty:>{name_len}}  {point:<{point_len}} {empty:<23} {power}W".format(
             empty="", name_len=name_len, point="Total power", point_len=point_len,
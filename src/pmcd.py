@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Acquisition daemon. Keeps one or more boards open, scans every mapped
+# channel continuously into a cache of recent records and serves clients
+# on a Unix domain socket. The protocol is one JSON object per line each
+# way:
+#
+#   {"op": "info"}                       -> {"sensors": {name: r}, "boards": [...]}
+#   {"op": "read", "channels": [...]}    -> record
+#   {"op": "stream", "channels": [...], "count": n, "rate": hz}
+#                                        -> record per scan, until count
+#   {"op": "on"|"off"|"toggle", "switches": [...]} -> {}
+#   {"op": "read_sw", "switches": [...]} -> {"switches": [[name, on, level], ...]}
+#
+# A record is {"t": time, "values": [[chan, shunt, bus, current, power, failed], ...]}.
+# A stream client that reads slower than the board scans pushes back on
+# its own connection only, the scan thread never waits for it. Records
+# that age out of the cache meanwhile are skipped and counted in the
+# "dropped" field of the next record sent.
+# Requests may name a "board", the first one is used otherwise. Errors are
+# returned as {"error": message}.
+
+import argparse
+import collections
+import json
+import os
+import pmc
+import socket
+import SocketServer
+import sys
+import threading
+import time
+
+SOCKET = '/tmp/pmcd.sock'
+
+class board(object):
+    # One open board and the thread scanning it. The device is only used
+    # with lock held, switch requests run between scan batches. A batch
+    # that fails is logged and the device reset, clients get the error
+    # until a batch succeeds again, retry seconds later at the earliest.
+    def __init__(self, device, channels, batch=16, rate=None, depth=1024, retry=1.0):
+        self.device = device
+        self.channels = [chan for chan in channels if chan in device.sensors]
+        self.batch = batch
+        self.rate = rate
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.records = collections.deque(maxlen=depth)
+        self.seq = 0
+        self.error = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                with self.lock:
+                    items = list(self.device.stream(self.channels, count=self.batch,
+                                                    batch=self.batch))
+            except Exception as e:
+                self.fail(e)
+                continue
+            with self.cond:
+                self.error = None
+                for t, record in items:
+                    self.seq += 1
+                    self.records.append((self.seq, t, record))
+                self.cond.notify_all()
+            if self.rate:
+                time.sleep(self.batch / self.rate)
+
+    def fail(self, e):
+        sys.stderr.write('pmcd: acquisition failed, {}\n'.format(
+            ' '.join(str(arg) for arg in e.args) or repr(e)))
+        with self.cond:
+            self.error = e
+            self.cond.notify_all()
+        time.sleep(self.retry)
+        try:
+            with self.lock:
+                self.device.reset()
+        except Exception as e:
+            sys.stderr.write('pmcd: reset failed, {}\n'.format(
+                ' '.join(str(arg) for arg in e.args) or repr(e)))
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def latest(self):
+        with self.cond:
+            while self.error is None and not self.records:
+                self.cond.wait(1.0)
+            if self.error is not None:
+                raise Exception("Acquisition failed", str(self.error))
+            return self.records[-1]
+
+    def since(self, seq, timeout=1.0):
+        # Records after seq, waiting for the next batch if there are none.
+        with self.cond:
+            if self.error is None and self.seq <= seq:
+                self.cond.wait(timeout)
+            if self.error is not None:
+                raise Exception("Acquisition failed", str(self.error))
+            return [item for item in self.records if item[0] > seq]
+
+    def switch(self, op, sw_list):
+        with self.lock:
+            getattr(self.device, op)(sw_list)
+
+    def switch_states(self, sw_list):
+        with self.lock:
+            return self.device.switch_states(sw_list)
+
+def encode(t, record, channels, dropped=0):
+    ret = dict(t=t, values=[[chan] + list(record[chan]) for chan in channels])
+    if dropped:
+        ret['dropped'] = dropped
+    return ret
+
+class handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+                b = self.server.boards[req.get('board') or self.server.names[0]]
+                op = req.get('op')
+                if op == 'info':
+                    self.reply(dict(boards=self.server.names,
+                                    sensors=dict((chan, b.device.sensors[chan].r)
+                                                 for chan in b.channels)))
+                elif op == 'read':
+                    channels = self.channels(b, req)
+                    seq, t, record = b.latest()
+                    self.reply(encode(t, record, channels))
+                elif op == 'stream':
+                    self.stream(b, self.channels(b, req), req.get('count'), req.get('rate'))
+                elif op in ('on', 'off', 'toggle'):
+                    b.switch(op, req['switches'])
+                    self.reply(dict())
+                elif op == 'read_sw':
+                    self.reply(dict(switches=b.switch_states(req['switches'])))
+                else:
+                    raise Exception("Unknown request", op)
+            except socket.error:
+                return
+            except Exception as e:
+                self.reply(dict(error=' '.join(str(arg) for arg in e.args) or repr(e)))
+
+    def channels(self, b, req):
+        channels = req.get('channels')
+        if channels is None:
+            return b.channels
+        for chan in channels:
+            if chan not in b.channels:
+                raise Exception("Not scanned", chan)
+        return channels
+
+    def stream(self, b, channels, count, rate):
+        period = 1.0 / rate if rate else 0
+        seq = b.seq
+        next_t = None
+        n = 0
+        dropped = 0
+        while count is None or n < count:
+            for item_seq, t, record in b.since(seq):
+                dropped += item_seq - seq - 1
+                seq = item_seq
+                if next_t is not None and t < next_t:
+                    continue
+                next_t = t + period
+                self.reply(encode(t, record, channels, dropped))
+                dropped = 0
+                n += 1
+                if n == count:
+                    break
+
+    def reply(self, obj):
+        self.wfile.write(json.dumps(obj, separators=(',', ':')) + '\n')
+        self.wfile.flush()
+
+def remove_stale(path):
+    # Remove the socket left by a daemon that is gone. A daemon still
+    # answering on it is not replaced.
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise Exception("A daemon is already running on", path)
+
+class server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, names, boards):
+        remove_stale(path)
+        SocketServer.UnixStreamServer.__init__(self, path, handler)
+        self.names = names
+        self.boards = dict(zip(names, boards))
+
+class client(object):
+    # Talks to the daemon with the same read(), stream() and switch calls
+    # as pmc.pmc, sensors maps each scanned channel to its shunt value.
+    def __init__(self, path=SOCKET, board=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.f = self.sock.makefile('rb')
+        self.board = board
+        self.sensors = self.request(op='info')['sensors']
+
+    def send(self, **req):
+        if self.board is not None:
+            req['board'] = self.board
+        self.sock.sendall(json.dumps(req, separators=(',', ':')) + '\n')
+
+    def receive(self):
+        line = self.f.readline()
+        if not line:
+            raise Exception("Daemon closed the connection")
+        ret = json.loads(line)
+        if 'error' in ret:
+            raise Exception(ret['error'])
+        return ret
+
+    def request(self, **req):
+        self.send(**req)
+        return self.receive()
+
+    def decode(self, ret):
+        return ret['t'], collections.OrderedDict((v[0], pmc.sample(*v[1:])) for v in ret['values'])
+
+    def read(self, channels):
+        channels = [chan for chan in channels if chan in self.sensors]
+        return self.decode(self.request(op='read', channels=channels))[1]
+
+    def stream(self, channels, rate=None, count=None, batch=1, use_alert=False, stats=None):
+        # batch and use_alert are the daemon's business and ignored.
+        channels = [chan for chan in channels if chan in self.sensors]
+        self.send(op='stream', channels=channels, count=count, rate=rate)
+        n = 0
+        while count is None or n < count:
+            t, record = self.decode(self.receive())
+            if stats is not None:
+                stats.add(t, record)
+            yield t, record
+            n += 1
+
+    def on(self, sw_list):
+        self.request(op='on', switches=sw_list)
+
+    def off(self, sw_list):
+        self.request(op='off', switches=sw_list)
+
+    def toggle(self, sw_list):
+        self.request(op='toggle', switches=sw_list)
+
+    def switch_states(self, sw_list):
+        return [tuple(s) for s in self.request(op='read_sw', switches=sw_list)['switches']]
+
+    def read_sw(self, sw_list):
+        for name, status, val in self.switch_states(sw_list):
+            print "{} {} ({})".format(name, "on" if status else "off", val)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--mapping', type=argparse.FileType('rb'), required=False)
+    parser.add_argument('-s', '--serial', type=str, action='append', required=False)
+    parser.add_argument('-i', '--index', type=int, required=False)
+    parser.add_argument('--sim', action="store_true")
+    parser.add_argument('-S', '--socket', type=str, default=SOCKET)
+    parser.add_argument('-r', '--rate', type=float, required=False)
+    parser.add_argument('-b', '--batch', type=int, default=16)
+    parser.add_argument('--i2c-rate', type=int, required=False)
+    args = parser.parse_args()
+
+    # Before the boards are opened, a running daemon holds them.
+    remove_stale(args.socket)
+    settings = dict()
+    points, mappings = pmc.load_mappings(args.mapping, settings)
+    serials = args.serial or [None]
+    boards = []
+    for serial in serials:
+        hz = pmc.bus_rate(serial, args.index, args.sim, settings, args.i2c_rate)
+        device = pmc.open_board(serial, args.index, points, mappings, args.sim, hz)
+        boards.append(board(device, mappings.keys(), args.batch, args.rate))
+    names = [serial or str(i) for i, serial in enumerate(serials)]
+    s = server(args.socket, names, boards)
+    try:
+        s.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    os.unlink(args.socket)
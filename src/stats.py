@@ -0,0 +1,223 @@
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Constant memory statistics over a stream of samples: count, mean and
+# variance (Welford), min/max and the trapezoidal integral over time,
+# which is energy for power and charge for current.
+
+import collections
+import math
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class running(object):
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.integral = 0.0
+        self.start = None
+        self.t = None
+        self.last = None
+
+    def add(self, t, v):
+        self.n += 1
+        d = v - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (v - self.mean)
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+        if self.t is None:
+            self.start = t
+        else:
+            self.integral += (t - self.t) * (v + self.last) / 2
+        self.t = t
+        self.last = v
+
+    def add_array(self, t, v):
+        # Merge a block of samples, combining the block's mean and variance
+        # with the running ones (Chan et al.). NaN samples, failed reads,
+        # are left out.
+        ok = ~numpy.isnan(v)
+        if not ok.all():
+            t = numpy.asarray(t)[ok]
+            v = v[ok]
+        n = len(v)
+        if not n:
+            return
+        mean = float(v.mean())
+        m2 = float(((v - mean) ** 2).sum())
+        total = self.n + n
+        d = mean - self.mean
+        self.mean += d * n / total
+        self.m2 += m2 + d * d * self.n * n / total
+        self.n = total
+        if self.min is None or v.min() < self.min:
+            self.min = float(v.min())
+        if self.max is None or v.max() > self.max:
+            self.max = float(v.max())
+        if self.t is None:
+            self.start = float(t[0])
+        else:
+            self.integral += (t[0] - self.t) * (v[0] + self.last) / 2
+        self.integral += float(numpy.sum(numpy.diff(t) * (v[1:] + v[:-1]) / 2))
+        self.t = float(t[-1])
+        self.last = float(v[-1])
+
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    def std(self):
+        return math.sqrt(self.variance())
+
+    def summary(self):
+        return dict(n=self.n, mean=self.mean, std=self.std(), min=self.min, max=self.max)
+
+class accumulator(object):
+    # Statistics of every channel of a record stream, of the total power of
+    # the rails and of the remainder, the input power not accounted for by
+    # them. Channels named input, or qualified by a board name and ending in
+    # "." + input, are inputs.
+    def __init__(self, input="CH16"):
+        self.input = input
+        self.channels = collections.OrderedDict()
+        self.total = running()
+        self.remainder = running()
+
+    def is_input(self, name):
+        return name == self.input or name.endswith('.' + self.input)
+
+    def quantities(self, name, current):
+        # Channels without a shunt value have no current, only voltages.
+        q = self.channels.get(name)
+        if q is None:
+            names = ['bus', 'shunt'] if current is None else ['bus', 'current', 'power']
+            q = self.channels[name] = collections.OrderedDict((n, running()) for n in names)
+        return q
+
+    def add(self, t, record):
+        # Add one record of pmc.sample values stamped t. Failed samples are
+        # skipped. As in the one-shot report, the total and remainder are
+        # of the samples that did not fail, a record without any power
+        # sample has neither and one without an input no remainder.
+        total = 0.0
+        inputs = None
+        powered = False
+        for name, s in record.items():
+            if s.failed:
+                continue
+            q = self.quantities(name, s.current)
+            q['bus'].add(t, s.bus)
+            if s.current is None:
+                q['shunt'].add(t, s.shunt)
+                continue
+            q['current'].add(t, s.current)
+            q['power'].add(t, s.power)
+            powered = True
+            if self.is_input(name):
+                inputs = (inputs or 0.0) + s.power
+            else:
+                total += s.power
+        if not powered:
+            return
+        self.total.add(t, total)
+        if inputs is not None:
+            self.remainder.add(t, inputs - total)
+
+    def add_scans(self, t, scans):
+        # Add (samples x channels) arrays, an ina226.scans. As with add(),
+        # failed samples, NaN, are skipped and the total and remainder of a
+        # scan are of the samples that did not fail.
+        t = numpy.asarray(t, dtype=numpy.float64)
+        total = numpy.zeros(len(t))
+        inputs = None
+        powered = numpy.zeros(len(t), dtype=bool)
+        has_input = numpy.zeros(len(t), dtype=bool)
+        for i, name in enumerate(scans.channels):
+            if numpy.isnan(scans.bus[:, i]).all():
+                continue
+            current = scans.current[:, i]
+            q = self.quantities(name, None if numpy.isnan(current).all() else current)
+            q['bus'].add_array(t, scans.bus[:, i])
+            if 'shunt' in q:
+                q['shunt'].add_array(t, scans.shunt[:, i])
+                continue
+            power = scans.power[:, i]
+            q['current'].add_array(t, current)
+            q['power'].add_array(t, power)
+            good = ~numpy.isnan(power)
+            powered |= good
+            if self.is_input(name):
+                has_input |= good
+                inputs = numpy.where(good, power, 0.0) + (0.0 if inputs is None else inputs)
+            else:
+                total += numpy.where(good, power, 0.0)
+        total[~powered] = numpy.nan
+        self.total.add_array(t, total)
+        if inputs is not None:
+            inputs[~has_input] = numpy.nan
+            self.remainder.add_array(t, inputs - total)
+
+    def summary(self):
+        # Statistics of every channel, then of the total and remainder
+        # power. Energy is in J and Wh, charge in C and Ah.
+        ret = collections.OrderedDict()
+        for name, q in self.channels.items():
+            ret[name] = s = dict((n, r.summary()) for n, r in q.items())
+            s['duration'] = 0.0 if q['bus'].t is None else q['bus'].t - q['bus'].start
+            if 'power' in q:
+                s['energy_j'] = q['power'].integral
+                s['energy_wh'] = q['power'].integral / 3600
+                s['charge_c'] = q['current'].integral
+                s['charge_ah'] = q['current'].integral / 3600
+        for name, r in (("Total", self.total), ("Remainder", self.remainder)):
+            if r.n:
+                ret[name] = dict(power=r.summary(), energy_j=r.integral,
+                                 energy_wh=r.integral / 3600,
+                                 duration=r.t - r.start)
+        return ret
+
+    def report(self, f=sys.stderr):
+        # Print summary() as a table.
+        f.write('# {:<20} {:>12} {:>12} {:>12} {:>12} {:>12} {:>12}\n'.format(
+                'channel', 'mean W', 'std W', 'min W', 'max W', 'energy J', 'charge C'))
+        for name, s in self.summary().items():
+            if 'power' not in s:
+                continue
+            p = s['power']
+            f.write('# {:<20} {:>12.6g} {:>12.6g} {:>12.6g} {:>12.6g} {:>12.6g} {:>12}\n'.format(
+                    name, p['mean'], p['std'], p['min'], p['max'], s['energy_j'],
+                    '{:.6g}'.format(s['charge_c']) if 'charge_c' in s else ''))
+        f.flush()
+
+def periodic(records, acc, interval, f=sys.stderr):
+    # Pass (t, record) items through, printing acc's report every interval
+    # seconds of record time and once more at the end.
+    next_t = None
+    try:
+        for t, record in records:
+            if next_t is None:
+                next_t = t + interval
+            elif t >= next_t:
+                acc.report(f)
+                next_t += interval * (1 + int((t - next_t) // interval))
+            yield t, record
+    finally:
+        acc.report(f)
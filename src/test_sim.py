@@ -0,0 +1,624 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Russ Dill <Russ.Dill@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# Checks run against the simulated board of ftdi_sim, no hardware needed.
+# Run with "python -m unittest test_sim" from this directory.
+
+import capture
+import decimate
+import ftdi_sim
+import ina226
+import math
+import os
+import pipeline
+import pmc
+import pmcd
+import shutil
+import StringIO
+import stats
+import sys
+import tempfile
+import time
+import unittest
+import warnings
+
+# name, address, shunt and mux input of the sensors of sim_board().
+SENSORS = [
+    ('CH1', 0x4f, 2.0, 1),
+    ('CH2', 0x4f, None, 2),
+    ('0x40', 0x40, 0.05, None),
+    ('0x43', 0x43, 2.0, None),
+    ('CH16', 0x4e, 0.05, None),
+]
+
+# Mux inputs, CH2 has a negative shunt voltage.
+CHANNELS = [((i + 1) * 100e-6, 1.0 + 0.1 * i) for i in range(0, 16)]
+CHANNELS[2] = (-250e-6, 1.2)
+
+def sim_board(**kwargs):
+    # A simulated board with SENSORS registered, and the board.
+    board = ftdi_sim.pmc17(pmc.addrs, pmc.alert, CHANNELS)
+    port = ftdi_sim.port(board, pmc.scl, pmc.sda_out, pmc.sda_in, **kwargs)
+    device = pmc.pmc(port=port)
+    for name, addr, r, mux_addr in SENSORS:
+        if mux_addr is None:
+            board.populate(addr)
+        device.add_sensor(name, addr, r, mux_addr)
+    return device, board
+
+def names():
+    return [name for name, addr, r, mux_addr in SENSORS]
+
+class temp_dir_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class decode_test(unittest.TestCase):
+    # The vectorized decode against the per scan one.
+    def test_parity(self):
+        device, board = sim_board()
+        channels = names()
+        # Past the first conversions, the inputs are constant from here.
+        device.read_scans(channels, 32)
+        values = device.read_arrays(channels, 8)
+        records = device.read_scans(channels, 8)
+        self.assertEqual(list(values.channels), channels)
+        for i, record in enumerate(records):
+            for j, chan in enumerate(channels):
+                s = record[chan]
+                self.assertAlmostEqual(values.shunt[i, j], s.shunt, 9)
+                self.assertAlmostEqual(values.bus[i, j], s.bus, 9)
+                if s.current is None:
+                    self.assertTrue(math.isnan(values.current[i, j]))
+                    self.assertTrue(math.isnan(values.power[i, j]))
+                else:
+                    self.assertAlmostEqual(values.current[i, j], s.current, 9)
+                    self.assertAlmostEqual(values.power[i, j], s.power, 9)
+        self.assertAlmostEqual(records[0]['CH2'].shunt, CHANNELS[2][0], 6)
+
+class fifo_test(unittest.TestCase):
+    # Flushes larger than the FIFOs go out in chunks, one kept in flight.
+    def test_chunked(self):
+        device, board = sim_board(rx_size=256, tx_size=512)
+        device.hw.tx_chunk = 256
+        device.hw.rx_chunk = 128
+        device.read_scans(['CH1', '0x40'], 32)
+        for record in device.read_scans(['CH1', '0x40'], 64):
+            self.assertAlmostEqual(record['CH1'].bus, CHANNELS[1][1], 2)
+            self.assertAlmostEqual(record['0x40'].bus, 1.2, 2)
+
+    def test_backpressure(self):
+        # The simulated engine stalls on a full RX FIFO, writes then back
+        # up.
+        device, board = sim_board(rx_size=64, tx_size=256)
+        device.hw.tx_chunk = 4096
+        device.hw.rx_chunk = 4096
+        with self.assertRaisesRegexp(Exception, "TX FIFO"):
+            device.read_scans(['CH1', '0x40'], 64)
+
+class config_test(unittest.TestCase):
+    # A direct sensor is configured by every run, even for the defaults,
+    # whatever an earlier run left on the chip.
+    def test_reset(self):
+        device, board = sim_board()
+        device.add_sensor('0x40', 0x40, 0.05, avg=64)
+        self.assertEqual(board.bus.devices[0x40].regs[0],
+                         ina226.config(64, 1100e-6, 1100e-6))
+        port = ftdi_sim.port(board, pmc.scl, pmc.sda_out, pmc.sda_in)
+        device = pmc.pmc(port=port)
+        device.add_sensor('0x40', 0x40, 0.05)
+        self.assertEqual(board.bus.devices[0x40].regs[0],
+                         ina226.DEFAULT_CONFIG)
+
+    def test_absent(self):
+        # Configuring a sensor that is not there fails its reads only.
+        device, board = sim_board()
+        device.add_sensor('0x45', 0x45, 0.05, avg=4)
+        record = device.read_scans(['0x40', '0x45'], 1)[0]
+        self.assertTrue(record['0x45'].failed)
+        self.assertFalse(record['0x40'].failed)
+
+class alert_test(unittest.TestCase):
+    # ALERT driven streams read one scan at a time and are paced by it.
+    def test_pacing(self):
+        device, board = sim_board()
+        t0 = time.time()
+        records = list(device.stream(['CH1', '0x40'], 50, 5, 4, True))
+        self.assertEqual(len(records), 5)
+        self.assertTrue(time.time() - t0 < 0.25)
+        self.assertAlmostEqual(records[-1][1]['CH1'].bus, CHANNELS[1][1], 3)
+
+    def test_timeout(self):
+        # A wait that times out leaves no tag or pending reads behind.
+        device, board = sim_board()
+        wait_pin = device.hw.wait_pin
+        def timeout(gpio, level, timeout=0.1):
+            raise Exception("Timed out waiting for GPIO", gpio)
+        device.hw.wait_pin = timeout
+        with self.assertRaisesRegexp(Exception, "Timed out"):
+            device.read_alert(['0x40', 'CH1'])
+        device.hw.wait_pin = wait_pin
+        self.assertEqual(device.hw.tag, None)
+        self.assertFalse(device.sensors['0x40'].pending)
+        self.assertFalse(device.sensors['CH1'].pending)
+        record = device.read_alert(['0x40', 'CH1'])
+        self.assertAlmostEqual(record['0x40'].bus, 1.2, 3)
+        self.assertAlmostEqual(record['CH1'].bus, CHANNELS[1][1], 3)
+
+class capture_test(unittest.TestCase):
+    # A capture leaves the sensor with its configuration, however it
+    # ends.
+    def test_restore(self):
+        device, board = sim_board()
+        device.add_sensor('0x40', 0x40, 0.05, avg=4)
+        trace = device.capture('0x40', 600, True)
+        self.assertEqual(len(trace.values), 600)
+        self.assertTrue(ina226.numpy.allclose(trace.values[8:], 1.2, atol=2e-3))
+        self.assertEqual(board.bus.devices[0x40].regs[0],
+                         ina226.config(4, 1100e-6, 1100e-6))
+
+    def test_interrupted(self):
+        device, board = sim_board()
+        device.add_sensor('0x40', 0x40, 0.05, avg=4)
+        port = device.hw.port
+        read = port.read
+        calls = []
+        def interrupt(buf, size):
+            calls.append(size)
+            if len(calls) == 2:
+                raise KeyboardInterrupt()
+            return read(buf, size)
+        port.read = interrupt
+        with self.assertRaises(KeyboardInterrupt):
+            device.capture('0x40', 2000, True)
+        port.read = read
+        self.assertEqual(board.bus.devices[0x40].regs[0],
+                         ina226.config(4, 1100e-6, 1100e-6))
+        record = device.read_scans(['CH1', '0x40'], 4)[-1]
+        self.assertAlmostEqual(record['0x40'].bus, 1.2, 3)
+        self.assertAlmostEqual(record['CH1'].bus, CHANNELS[1][1], 3)
+
+    def test_nack(self):
+        # A sensor that does not answer gives NaN samples.
+        device, board = sim_board()
+        device.add_sensor('0x45', 0x45, 0.05)
+        trace = device.capture('0x45', 300)
+        self.assertEqual(len(trace.values), 300)
+        self.assertTrue(ina226.numpy.isnan(trace.values).all())
+        # One that goes away part way only fails the reads after that.
+        port = device.hw.port
+        read = port.read
+        def gone(buf, size):
+            board.bus.devices.pop(0x40, None)
+            return read(buf, size)
+        port.read = gone
+        nan = ina226.numpy.isnan(device.capture('0x40', 2000, True).values)
+        self.assertTrue(0 < nan.argmax() < 1000)
+        self.assertTrue(nan[nan.argmax():].all())
+
+class stats_test(unittest.TestCase):
+    # Welford mean and variance, min/max and the trapezoidal integral,
+    # sample by sample and in blocks.
+    def test_running(self):
+        numpy = stats.numpy
+        rng = numpy.random.RandomState(14)
+        t = numpy.cumsum(rng.random_sample(1000))
+        v = 1e6 + rng.normal(size=1000)
+        one = stats.running()
+        for t_i, v_i in zip(t, v):
+            one.add(t_i, v_i)
+        blocks = stats.running()
+        for i in range(0, 1000, 137):
+            blocks.add_array(t[i:i + 137], v[i:i + 137])
+        energy = numpy.sum(numpy.diff(t) * (v[1:] + v[:-1]) / 2)
+        for r in (one, blocks):
+            self.assertEqual(r.n, 1000)
+            self.assertAlmostEqual(r.mean, v.mean(), 6)
+            self.assertAlmostEqual(r.std(), v.std(ddof=1), 6)
+            self.assertEqual(r.min, v.min())
+            self.assertEqual(r.max, v.max())
+            self.assertAlmostEqual(r.integral / energy, 1.0, 9)
+
+    def test_accumulator(self):
+        device, board = sim_board()
+        channels = ['CH1', '0x40', 'CH16']
+        device.read_scans(channels, 32)
+        acc = stats.accumulator()
+        for i, record in enumerate(device.read_scans(channels, 10)):
+            acc.add(i * 0.5, record)
+        summary = acc.summary()
+        power = CHANNELS[1][0] / 2.0 * CHANNELS[1][1]
+        self.assertAlmostEqual(summary['CH1']['power']['mean'], power, 9)
+        self.assertAlmostEqual(summary['CH1']['energy_j'], power * 4.5, 9)
+        self.assertAlmostEqual(summary['Remainder']['power']['mean'],
+                               summary['CH16']['power']['mean'] -
+                               summary['Total']['power']['mean'], 9)
+
+    def test_failed_rails(self):
+        # A rail that does not answer is left out of the total and
+        # remainder, as in the one-shot report, rather than dropping them.
+        device, board = sim_board()
+        channels = ['CH1', '0x40', '0x43', 'CH16']
+        device.read_scans(channels, 32)
+        del board.bus.devices[0x43]
+        one = stats.accumulator()
+        for i, record in enumerate(device.read_scans(channels, 10)):
+            one.add(i * 0.5, record)
+        blocks = stats.accumulator()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            blocks.add_scans(stats.numpy.arange(10) * 0.5,
+                             device.read_arrays(channels, 10))
+        for acc in (one, blocks):
+            summary = acc.summary()
+            self.assertNotIn('0x43', summary)
+            total = (summary['CH1']['power']['mean'] +
+                     summary['0x40']['power']['mean'])
+            self.assertEqual(summary['Total']['power']['n'], 10)
+            self.assertAlmostEqual(summary['Total']['power']['mean'], total, 9)
+            self.assertAlmostEqual(summary['Remainder']['power']['mean'],
+                                   summary['CH16']['power']['mean'] - total, 9)
+        # Without any power sample there is nothing to total.
+        del board.bus.devices[0x40]
+        acc = stats.accumulator()
+        for i, record in enumerate(device.read_scans(['0x40', '0x43'], 4)):
+            acc.add(i * 0.5, record)
+        self.assertNotIn('Total', acc.summary())
+
+class triggered_test(unittest.TestCase):
+    # Scans before a switch edge see the old input, those a few
+    # conversions after it the new one, on the MPSSE timeline.
+    def test_edge(self):
+        def dc_in(t):
+            # SW0 switches the input from 5V to 3V.
+            if board.pins & pmc.bit(pmc.sws[0]):
+                return 5e-3, 3.0
+            return 5e-3, 5.0
+        board = ftdi_sim.pmc17(pmc.addrs, pmc.alert, CHANNELS, dc_in)
+        device = pmc.pmc(port=ftdi_sim.port(board, pmc.scl, pmc.sda_out, pmc.sda_in))
+        device.add_sensor('CH16', 0x4e, 0.05)
+        device.add_switch('SW0', 'LOAD')
+        device.on(['LOAD'])
+        device.read_scans(['CH16'], 32)
+        records = device.triggered(['CH16'], 10, 40, ['LOAD'], False)
+        times = [t for t, record in records]
+        self.assertEqual(len(records), 50)
+        self.assertTrue(all(a < b for a, b in zip(times, times[1:])))
+        self.assertTrue(times[9] < 0 < times[10])
+        for t, record in records:
+            if t < 0:
+                self.assertAlmostEqual(record['CH16'].bus, 3.0, 3)
+            elif t > 2 * 2 * 1100e-6 + device.scan_program(['CH16']).duration:
+                self.assertAlmostEqual(record['CH16'].bus, 5.0, 3)
+        self.assertAlmostEqual(records[-1][1]['CH16'].bus, 5.0, 3)
+
+class daemon_test(unittest.TestCase):
+    # The scan thread lives through an error, logs it and picks up again.
+    def test_recovery(self):
+        device, board = sim_board()
+        port = device.hw.port
+        read = port.read
+        calls = []
+        def glitch(buf, size):
+            # One transfer is lost part way through a flush.
+            calls.append(size)
+            ret = read(buf, size)
+            if len(calls) == 20:
+                raise Exception("USB glitch")
+            return ret
+        port.read = glitch
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            b = pmcd.board(device, ['CH1', '0x40'], 4, retry=0)
+            end = time.time() + 10
+            while len(calls) < 100 and time.time() < end:
+                time.sleep(0.01)
+            b.stop()
+            log = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertIn("USB glitch", log)
+        self.assertIsNone(b.error)
+        seq, t, record = b.latest()
+        self.assertTrue(seq > 20)
+        self.assertAlmostEqual(record['CH1'].bus, CHANNELS[1][1], 3)
+        self.assertAlmostEqual(record['0x40'].bus, 1.2, 3)
+
+class nack_test(unittest.TestCase):
+    # A sensor that does not answer fails only its own samples.
+    def test_isolation(self):
+        device, board = sim_board()
+        channels = names()
+        device.read_scans(channels, 32)
+        del board.bus.devices[0x43]
+        for record in device.read_scans(channels, 4):
+            for chan, s in record.items():
+                self.assertEqual(s.failed, chan == '0x43')
+            self.assertTrue(math.isnan(record['0x43'].bus))
+            self.assertAlmostEqual(record['0x40'].bus, 1.2, 3)
+        values = device.read_arrays(channels, 4)
+        self.assertTrue(ina226.numpy.isnan(values.bus[:, 3]).all())
+        self.assertFalse(ina226.numpy.isnan(values.bus[:, [0, 1, 2, 4]]).any())
+
+    def test_retries(self):
+        # 0x43 is gone for the first flush only, a retry picks it up.
+        for retries, failed in ((0, True), (1, False)):
+            device, board = sim_board()
+            device.read_scans(['0x40', '0x43'], 32)
+            sensor = board.bus.devices.pop(0x43)
+            flush = device.i2c.flush
+            def once():
+                flush()
+                board.bus.devices[0x43] = sensor
+            device.i2c.flush = once
+            records = device.read_scans(['0x40', '0x43'], 3, retries)
+            for record in records:
+                self.assertEqual(record['0x43'].failed, failed)
+                self.assertFalse(record['0x40'].failed)
+
+class ring_test(temp_dir_test):
+    # Scans through a ring are either read by a follower or counted as
+    # overruns, never both and never out of order.
+    def test_overruns(self):
+        numpy = capture.numpy
+        path = os.path.join(self.dir, 'ring')
+        batch = 16
+        out = capture.writer(path, ['A'], [None], 100)
+        follower = pipeline.follower(path, batch)
+        rng = numpy.random.RandomState(21)
+        written = 0
+        seen = []
+        for i in range(0, 200):
+            t = numpy.arange(written, written + batch, dtype=numpy.float64)
+            raw = numpy.zeros((batch, 1), dtype=numpy.uint16)
+            out.append(t, raw.view(numpy.int16), raw)
+            written += batch
+            # A slow reader, now and then far more than a ring behind.
+            if rng.random_sample() < 0.3:
+                seen.extend(follower.read()['t'])
+        seen.extend(follower.read()['t'])
+        out.close()
+        self.assertEqual(len(seen) + follower.overruns, written)
+        self.assertTrue(follower.overruns > 0)
+        self.assertTrue(all(a < b for a, b in zip(seen, seen[1:])))
+        self.assertEqual(seen[-1], written - 1)
+
+    def test_failed(self):
+        numpy = capture.numpy
+        path = os.path.join(self.dir, 'ring')
+        out = capture.writer(path, ['A', 'B'], [1.0, 1.0], 10)
+        raw = numpy.ones((2, 2), dtype=numpy.uint16)
+        out.append([0.0, 1.0], raw.view(numpy.int16), raw,
+                   numpy.array([[False, True], [False, False]]))
+        out.close()
+        t, scans = capture.reader(path).decode()
+        self.assertTrue(numpy.isnan(scans.power[0, 1]))
+        self.assertFalse(numpy.isnan(scans.power[[0, 1, 1], [0, 0, 1]]).any())
+
+    def test_record(self):
+        # record() keeps NACKed reads flagged in the capture.
+        device, board = sim_board()
+        channels = ['0x40', '0x43']
+        device.read_scans(channels, 32)
+        del board.bus.devices[0x43]
+        path = os.path.join(self.dir, 'ring')
+        out = capture.writer(path, channels, [0.05, 2.0], 100)
+        acc = stats.accumulator()
+        device.record(out, channels, 8, 4, acc)
+        out.close()
+        f = capture.reader(path)
+        self.assertTrue(f.records()['failed'][:, 1].all())
+        self.assertFalse(f.records()['failed'][:, 0].any())
+        t, scans = f.decode()
+        self.assertTrue(capture.numpy.isnan(scans.bus[:, 1]).all())
+        self.assertEqual(acc.summary()['0x40']['bus']['n'], 8)
+        self.assertNotIn('0x43', acc.summary())
+
+class pyramid_test(temp_dir_test):
+    # Every level against a brute-force min/max/mean of the same scans.
+    def test_levels(self):
+        numpy = decimate.numpy
+        rng = numpy.random.RandomState(17)
+        n, channels, base = 5000, 3, 3
+        shunt = rng.normal(size=(n, channels))
+        bus = rng.normal(size=(n, channels))
+        power = rng.normal(size=(n, channels))
+        failed = rng.random_sample((n, channels)) < 0.05
+        failed[:64, 1] = True
+        for values in (shunt, bus, power):
+            values[failed] = numpy.nan
+        t = numpy.arange(n, dtype=numpy.float64)
+
+        path = os.path.join(self.dir, 'pyr')
+        pyr = decimate.pyramid(path, ['A', 'B', 'C'], [1.0, 1.0, None], base)
+        for i in range(0, n, 333):
+            scans = ina226.scans(['A', 'B', 'C'], shunt[i:i + 333], bus[i:i + 333],
+                                 shunt[i:i + 333], power[i:i + 333])
+            pyr.add_scans(t[i:i + 333], scans)
+        pyr.close()
+
+        r = decimate.reader(path)
+        k = base
+        while True:
+            level = r.level(k)
+            size = 1 << k
+            m = n // size
+            if not m:
+                self.assertEqual(len(level), 0)
+                break
+            self.assertEqual(len(level), m)
+            self.assertTrue((level['t0'] == t[:m * size:size]).all())
+            self.assertTrue((level['t1'] == t[size - 1:m * size:size]).all())
+            ok = ~failed[:m * size].reshape(m, size, channels)
+            self.assertTrue((level['valid'] == ok.sum(axis=1)).all())
+            for q, values in enumerate((shunt, bus, power)):
+                v = values[:m * size].reshape(m, size, channels)
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    expect = (numpy.nanmin(v, axis=1), numpy.nanmax(v, axis=1),
+                              numpy.nanmean(v, axis=1))
+                for stat, e in zip(('min', 'max', 'mean'), expect):
+                    got = level[stat][:, q, :].astype(numpy.float64)
+                    self.assertTrue(numpy.allclose(got, e, rtol=1e-5, atol=1e-5,
+                                                   equal_nan=True), (k, stat, q))
+            k += 1
+
+    def test_envelope(self):
+        numpy = decimate.numpy
+        n = 4096
+        t = numpy.arange(n, dtype=numpy.float64)
+        v = numpy.sin(t / 100)[:, None]
+        path = os.path.join(self.dir, 'pyr')
+        pyr = decimate.pyramid(path, ['A'], [None], 2)
+        pyr.add_scans(t, ina226.scans(['A'], v, v, v, v))
+        pyr.close()
+        r = decimate.reader(path)
+        for t1, t2, points in ((0, n, 100), (1000, 1500, 40), (17, 3000, 1000)):
+            t0s, t1s, lo, hi, mean = r.envelope(t1, t2, points, 'A')
+            self.assertTrue(len(t0s) <= points + 2)
+            self.assertTrue(t0s[0] <= t1 and t1s[-1] >= min(t2, n - 1))
+            for a, b, l, h in zip(t0s, t1s, lo['bus'], hi['bus']):
+                window = v[int(a):int(b) + 1, 0]
+                self.assertAlmostEqual(l, window.min(), 5)
+                self.assertAlmostEqual(h, window.max(), 5)
+
+class fake_usb_device(object):
+    # A pyusb legacy device, string descriptors 1 and 2 are the product
+    # and serial.
+    def __init__(self, devnum, product, serial, vendor=0x0403, device=0x6010):
+        self.devnum = devnum
+        self.idVendor = vendor
+        self.idProduct = device
+        self.iProduct = 1
+        self.iSerialNumber = 2
+        self.strings = {1: product, 2: serial}
+
+    def open(self):
+        return self
+
+    def getString(self, index, length):
+        return self.strings[index]
+
+class rate_test(unittest.TestCase):
+    # Boards are only looked up for a calibrated rate, and only PMC-17s
+    # count towards --index.
+    def test_lazy(self):
+        def lookup(serial=None, index=None, sim=False):
+            raise Exception("Looked up", serial, index)
+        board_name = pmc.board_name
+        pmc.board_name = lookup
+        try:
+            self.assertEqual(pmc.bus_rate(None, 1, False, None, 100000), 100000)
+            self.assertEqual(pmc.bus_rate(None, 1, False, dict(rate=200000)), 200000)
+        finally:
+            pmc.board_name = board_name
+
+    def test_list(self):
+        class bus(object):
+            dirname = '001'
+            devices = [fake_usb_device(2, "PMC-17 v1.0", 'A'),
+                       fake_usb_device(3, "Dual RS232-HS", 'FT1'),
+                       fake_usb_device(4, "PMC-17 v1.0", 'B', device=0x6014),
+                       fake_usb_device(5, "PMC-17 v1.0", 'C')]
+        busses = pmc.usb.busses
+        pmc.usb.busses = lambda: [bus]
+        try:
+            self.assertEqual(pmc.list_boards(), [('001', 2, 'A'), ('001', 5, 'C')])
+            self.assertEqual(pmc.board_name(index=1), 'C')
+        finally:
+            pmc.usb.busses = busses
+
+class registers_test(unittest.TestCase):
+    # The batched register dump against one flushed read per register.
+    def test_dump(self):
+        device, board = sim_board()
+        # Not the mask/enable register, reading it clears its flags.
+        regs = (0, 1, 2, 5, 7, 0xfe, 0xff)
+        channels = names()
+        writes = device.hw.port.writes
+        dump = device.registers(channels, regs)
+        batched = device.hw.port.writes - writes
+        writes = device.hw.port.writes
+        for chan in channels:
+            s = device.sensors[chan]
+            for reg in regs:
+                if s.mux_addr is not None:
+                    device.addr(s.mux_addr)
+                self.assertEqual(dump[chan][reg], device.i2c.smbus_read_word_data(s.addr, reg))
+            self.assertEqual(dump[chan][0xfe], ina226.MANUFACTURER_ID)
+        self.assertTrue(batched < device.hw.port.writes - writes)
+
+    def test_nack(self):
+        device, board = sim_board()
+        del board.bus.devices[0x43]
+        dump = device.registers(['0x40', '0x43'], (0xfe,))
+        self.assertEqual(dump['0x40'][0xfe], ina226.MANUFACTURER_ID)
+        self.assertEqual(dump['0x43'], None)
+
+    def test_block_nack(self):
+        # A block read of a sensor that is not there fails like any other
+        # NACK, and the bus is free again afterwards.
+        device, board = sim_board()
+        with self.assertRaisesRegexp(Exception, "I2C error"):
+            device.i2c.smbus_read_block_data(0x45, 0)
+        self.assertEqual(device.i2c.smbus_read_word_data(0x40, 0xfe),
+                         ina226.MANUFACTURER_ID)
+
+    def test_tag(self):
+        # Channels are untagged again however a dump or verify ends.
+        device, board = sim_board()
+        for func in (device.registers, device.verify):
+            with self.assertRaises(KeyError):
+                func(['0x40', 'CH99'])
+            self.assertEqual(device.hw.tag, None)
+
+    def test_batch_exception(self):
+        # Nothing queued in a batch that raised goes out later.
+        device, board = sim_board()
+        try:
+            with device.i2c.batch():
+                device.i2c.smbus_write_word_data(0x40, 5, 0x1234)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(device.i2c.smbus_read_word_data(0x40, 5), 0)
+
+class fake_board(object):
+    # Streams a fixed list of record times, the bus voltage being the
+    # time.
+    def __init__(self, times):
+        self.times = times
+
+    def stream(self, channels, rate, count, batch):
+        for t in self.times:
+            yield t, {'X': pmc.sample(1.0, t, 1.0, 1.0, False)}
+
+class group_test(unittest.TestCase):
+    # Boards are merged on the first board's times with the nearest
+    # sample of every other board, failed if none is within a period.
+    def test_merge(self):
+        a = [0.0, 0.1, 0.2, 0.3, 0.4]
+        b = [0.02, 0.13, 0.35, 0.41]
+        boards = pmc.group(['A', 'B'], [lambda: fake_board(a), lambda: fake_board(b)])
+        records = list(boards.stream(['X'], 20))
+        self.assertEqual([t for t, record in records], a)
+        got = [record['B.X'] for t, record in records]
+        self.assertEqual([s.failed for s in got], [False, False, True, False, False])
+        self.assertEqual([s.bus for s in got if not s.failed], [0.02, 0.13, 0.35, 0.41])
+
+if __name__ == "__main__":
+    unittest.main()